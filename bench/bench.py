@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+#
+# PyModules - Software Environments for Research Computing Clusters
+#
+# Copyright 2012-2013, Brown University, Providence, RI. All Rights Reserved.
+#
+# This file is part of PyModules.
+#
+# Permission to use, copy, modify, and distribute this software and its
+# documentation for any purpose other than its incorporation into a
+# commercial product is hereby granted without fee, provided that the
+# above copyright notice appear in all copies and that both that
+# copyright notice and this permission notice appear in supporting
+# documentation, and that the name of Brown University not be used in
+# advertising or publicity pertaining to distribution of the software
+# without specific, written prior permission.
+#
+# BROWN UNIVERSITY DISCLAIMS ALL WARRANTIES WITH REGARD TO THIS SOFTWARE,
+# INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR ANY
+# PARTICULAR PURPOSE.  IN NO EVENT SHALL BROWN UNIVERSITY BE LIABLE FOR
+# ANY SPECIAL, INDIRECT OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Each benchmark runs in its own process, since the configuration is read
+# from the environment when PyModules is imported, and so that the peak
+# memory of one benchmark doesn't hide the next one's.
+BENCHMARKS = ('rebuild', 'insert', 'lookup', 'avail-name', 'avail-category',
+              'load', 'unload', 'bin')
+
+CATEGORIES = 20
+BINDIRS = 100
+PROGRAMS = 20
+
+# Variables set by the generated modules, which are exported between the
+# load and unload benchmarks.
+VARIABLES = ('PATH', 'LD_LIBRARY_PATH', 'MANPATH', 'PKGROOT', 'LOADEDMODULES')
+
+
+def generate(path, n, versions, paths):
+    """
+    Write a tree of n modulefiles with the versions, whose PATH and
+    LD_LIBRARY_PATH actions have `paths` directories each. The first
+    directory in PATH is one of a pool of real bin directories, so that the
+    index and `module bin` have programs to list.
+    """
+
+    modulepath = os.path.join(path, 'modulefiles')
+    opt = os.path.join(path, 'opt')
+    os.makedirs(modulepath)
+
+    for i in range(BINDIRS):
+        bindir = os.path.join(opt, 'bin%03d' % i)
+        os.makedirs(bindir)
+        for j in range(PROGRAMS):
+            program = os.path.join(bindir, 'prog%03d%02d' % (i, j))
+            open(program, 'w').close()
+            os.chmod(program, 0755)
+
+    for i in range(n):
+        name = 'pkg%05d' % i
+        f = open(os.path.join(modulepath, name), 'w')
+        try:
+            f.write("[DEFAULT]\n")
+            f.write("brief = Synthetic package %d\n" % i)
+            f.write("url = http://example.com/%s\n" % name)
+            f.write("category = cat%02d\n" % (i % CATEGORIES))
+            bindirs = [os.path.join(opt, 'bin%03d' % (i % BINDIRS))]
+            bindirs += ['%%(rootdir)s/bin%d' % j for j in range(1, paths)]
+            libdirs = ['%%(rootdir)s/lib%d' % j for j in range(paths)]
+            f.write("prepend PATH = %s\n" % ':'.join(bindirs))
+            f.write("prepend LD_LIBRARY_PATH = %s\n" % ':'.join(libdirs))
+            f.write("prepend MANPATH = %(rootdir)s/share/man\n")
+            f.write("set PKGROOT = %(rootdir)s\n")
+            for v in range(versions):
+                f.write("\n[%d.%d.%d]\n" % (v + 1, i % 10, v * 7 % 10))
+                if v == versions // 2:
+                    f.write("default = true\n")
+        finally:
+            f.close()
+
+    return modulepath
+
+
+def percentile(times, p):
+    """ Returns the pth percentile of a sorted list of times """
+
+    return times[min(len(times) - 1, int(len(times) * p / 100.0))]
+
+
+class Quiet:
+    """
+    Sends the messages that PyModules prints to stdout and stderr to
+    /dev/null while it is timed.
+    """
+
+    def __enter__(self):
+        self.devnull = open(os.devnull, 'w')
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = self.devnull
+
+    def __exit__(self, *exc):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        self.devnull.close()
+
+
+def run(args):
+    """
+    Run one benchmark in this process, on the tree in MODULEPATH, and print
+    its times in seconds and peak memory in KB as a JSON line.
+    """
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+    import modulecmd
+    from module import ModuleDb, ModuleEnv
+    from modulecfg import MODULEPATH
+
+    names = sorted(os.listdir(MODULEPATH))
+    names = [name for name in names if name.startswith('pkg')]
+    rand = random.Random(args.seed)
+    times = []
+
+    def sample(runs):
+        for _ in range(runs):
+            yield rand.sample(names, 1)[0]
+
+    def timed(func, *funcargs):
+        with Quiet():
+            t = time.time()
+            func(*funcargs)
+            times.append(time.time() - t)
+
+    if args.run == 'rebuild':
+        for _ in range(args.slow):
+            timed(ModuleDb().rebuild, MODULEPATH, args.jobs)
+    elif args.run == 'insert':
+        for name in sample(args.slow):
+            timed(ModuleDb().insert, os.path.join(MODULEPATH, name), True)
+    elif args.run == 'lookup':
+        moduledb = ModuleDb(readonly=True)
+        for name in sample(args.runs):
+            timed(moduledb.lookup, name)
+    elif args.run in ('avail-name', 'avail-category', 'bin'):
+        subcommand = 'bin' if args.run == 'bin' else 'avail'
+        moduledb = ModuleDb(readonly=True)
+        for name in sample(args.runs):
+            if args.run == 'avail-category':
+                name = ':cat%02d' % rand.randrange(CATEGORIES)
+            cmdargs = modulecmd.parse_args(['modulecmd', subcommand, name])
+            cmdargs.moduledb = moduledb
+            timed(cmdargs.func, cmdargs)
+    elif args.run in ('load', 'unload'):
+        # Each run loads, or unloads, a set of modules into one environment.
+        moduledb = ModuleDb(readonly=True)
+        environ = dict((var, os.environ.get(var)) for var in VARIABLES)
+
+        def load(modules, env):
+            for module in modules:
+                module.load(env)
+            env.dump(open(os.devnull, 'w'))
+
+        def unload(modules, env):
+            for module in modules:
+                module.unload(env, strict=True)
+            env.dump(open(os.devnull, 'w'))
+
+        for _ in range(args.runs):
+            modules = [moduledb.lookup(name)
+                       for name in rand.sample(names, args.load)]
+            for var, value in environ.iteritems():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+            env = ModuleEnv()
+            if args.run == 'load':
+                timed(load, modules, env)
+            else:
+                load(modules, env)
+                for var in VARIABLES:
+                    os.environ[var] = env.get(var) or ''
+                timed(unload, modules, ModuleEnv())
+
+    # The children are the processes that parse modulefiles and scan
+    # directories in parallel.
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print json.dumps({'times': times, 'maxrss': maxrss})
+
+
+def benchmark(args, modulepath, n, name):
+    """
+    Run a benchmark in a new process on the tree, and return its results.
+    """
+
+    env = dict(os.environ, MODULEPATH=modulepath, MODULESHELL='bash')
+    for var in ('LOADEDMODULES', 'MODULESOCKET', 'MODULELOCALIZATION'):
+        env.pop(var, None)
+    argv = [sys.executable, os.path.abspath(__file__), '--run', name,
+            '--seed', str(args.seed), '--runs', str(args.runs),
+            '--slow', str(args.slow), '--load', str(args.load)]
+    if args.jobs:
+        argv += ['--jobs', str(args.jobs)]
+
+    child = subprocess.Popen(argv, env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = child.communicate()
+    if child.returncode:
+        sys.stderr.write(err)
+        raise SystemExit("benchmark '%s' failed for %d modules" % (name, n))
+    results = json.loads(out.splitlines()[-1])
+    results.update(modules=n, benchmark=name)
+    return results
+
+
+def main():
+
+    parser = argparse.ArgumentParser(prog='bench.py', description="""
+        Time the database and module commands of PyModules on generated
+        trees of modulefiles.""")
+    parser.add_argument('-n','--modules',type=int,nargs='+',
+        default=[100, 1000, 5000, 20000],
+        help="sizes of the trees to generate (default: 100 1000 5000 20000)")
+    parser.add_argument('-v','--versions',type=int,default=5,
+        help="versions per module (default: 5)")
+    parser.add_argument('-p','--paths',type=int,default=8,
+        help="directories in each PATH and LD_LIBRARY_PATH action "
+             "(default: 8)")
+    parser.add_argument('-b','--benchmarks',nargs='+',default=BENCHMARKS,
+        choices=BENCHMARKS,metavar='BENCHMARK',
+        help="benchmarks to run, from: %s (default: all)" % ' '.join(BENCHMARKS))
+    parser.add_argument('-r','--runs',type=int,default=200,
+        help="runs of each fast benchmark (default: 200)")
+    parser.add_argument('-s','--slow',type=int,default=3,
+        help="runs of rebuild and insert (default: 3)")
+    parser.add_argument('-l','--load',type=int,default=10,
+        help="modules loaded or unloaded in each run (default: 10)")
+    parser.add_argument('-j','--jobs',type=int,
+        help="number of processes for rebuild (default: one per CPU)")
+    parser.add_argument('--seed',type=int,default=1,
+        help="seed for choosing the modules of each run (default: 1)")
+    parser.add_argument('-d','--dir',
+        help="directory for the trees, which is kept (default: a temporary "
+             "directory that is removed)")
+    parser.add_argument('-o','--output',
+        help="append the times of every run to a file, as JSON lines")
+    parser.add_argument('--run',choices=BENCHMARKS,help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run:
+        run(args)
+        return
+
+    path = args.dir or tempfile.mkdtemp(prefix='pymodules-bench.')
+    output = open(args.output, 'a') if args.output else None
+
+    print "%8s  %-15s %5s %9s %9s %9s %9s %10s" % (
+          'modules', 'benchmark', 'runs', 'p50 ms', 'p90 ms', 'p99 ms',
+          'max ms', 'maxrss MB')
+    try:
+        for n in args.modules:
+            modulepath = generate(os.path.join(path, str(n)),
+                                  n, args.versions, args.paths)
+            # The other benchmarks need the database that rebuild creates.
+            benchmarks = ['rebuild'] + [b for b in args.benchmarks
+                                        if b != 'rebuild']
+            for name in benchmarks:
+                results = benchmark(args, modulepath, n, name)
+                if name not in args.benchmarks:
+                    continue
+                times = sorted(results['times'])
+                print "%8d  %-15s %5d %9.2f %9.2f %9.2f %9.2f %10.1f" % (
+                      n, name, len(times),
+                      1000 * percentile(times, 50),
+                      1000 * percentile(times, 90),
+                      1000 * percentile(times, 99),
+                      1000 * times[-1], results['maxrss'] / 1024.0)
+                sys.stdout.flush()
+                if output:
+                    print >>output, json.dumps(results)
+    finally:
+        if output:
+            output.close()
+        if not args.dir:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ts=4:shiftwidth=4:expandtab:
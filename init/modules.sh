@@ -30,6 +30,10 @@ export MODULEPATH=/gpfs/runtime/modulefiles
 export MODULESHELL=bash
 export MODULEPYTHON=/usr/bin/python
 
+# Uncomment to send module commands to a module server (see moduleserver.py)
+# listening on this socket, instead of running them in a new Python process.
+#export MODULESOCKET=/var/run/pymodules.sock
+
 # Exclude the following space-separated list of users from loading the modules
 # environment.
 EXCLUDE_USERS="root"
@@ -43,9 +47,16 @@ for u in $EXCLUDE_USERS; do
 	fi
 done
 
-# Create a function that evaluates the stdout of the modulecmd script.
+# Create a function that evaluates the stdout of the modulecmd script, which
+# the client forwards to the module server if one is running.
 module() {
-	eval `${MODULEPYTHON} ${MODULEHOME}/modulecmd.py $*`;
+	case " $* " in
+	*" --json "*)
+		# JSON output is for other programs, not the shell.
+		${MODULEPYTHON} ${MODULEHOME}/moduleclient.py $*;;
+	*)
+		eval `${MODULEPYTHON} ${MODULEHOME}/moduleclient.py $*`;;
+	esac
 }
 export -f module
 
@@ -57,28 +68,14 @@ export -f moduledb
 
 # Setup auto-completion.
 
-# Match all possible expansions of name/version in the database, where
-# name has to start with the partial string, but version just needs to
-# contain the partial string.
+# Match all module ids in the database that start with the partial string,
+# using the completion file that moduledb writes next to the database.
 _module_avail_complete() {
-	# Split the module 'name' into the name proper and the version string.
-	local name=(${1/\// })
-	if [ ${#name[@]} -gt 1 -o "$1" == "${name[0]}/" ]
-	then
-		echo "	SELECT name, version
-			FROM moduleids
-			WHERE name='${name[0]}' AND version LIKE '${name[1]}%';" | \
-			sqlite3 -separator / ${MODULEPATH}/.db.sqlite
-	else
-		echo "	SELECT name, version
-			FROM moduleids
-			WHERE name LIKE '${name[0]}%';" | \
-			sqlite3 -separator / ${MODULEPATH}/.db.sqlite
-	fi
+	${MODULEPYTHON} ${MODULEHOME}/modulecmd.py complete "$1"
 }
 
 _module_complete() {
-	local cur="$2" pos=$COMP_CWORD cmds="add avail bin clear display help list load purge rm show swap switch unload whatis"
+	local cur="$2" pos=$COMP_CWORD cmds="add avail bin clear display help list load provides purge restore rm save show swap switch unload whatis"
 
 	COMPREPLY=()
 
@@ -103,11 +100,8 @@ _module_complete() {
 complete -F _module_complete module
 
 # Load default modules, first from the global defaults, then from the user's
-# ~/.modules file.
-if [ -r ${MODULEPATH}/.modules ]; then
-	. ${MODULEPATH}/.modules
-fi
-if [ -r ${HOME}/.modules ]; then
-	. ${HOME}/.modules
-fi
+# ~/.modules file. Profiles that only contain `module load` and `module
+# restore` lines are loaded in a single modulecmd process, and any others are
+# sourced afterwards.
+module init
 
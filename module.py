@@ -22,14 +22,15 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-import ConfigParser
+import itertools
 import os
-import pickle
 import sys
 import sqlite3 as sqlite
+import time
 
 from modulecfg import *
-from moduleutil import splitid, localize, info, print_columns
+from moduleutil import splitid, localize, localizations, localization, info, print_columns
+from moduleutil import make_localdir, record_usage, trusted, version_key
 
 
 class ModuleError(Exception):
@@ -46,10 +47,29 @@ class ModuleError(Exception):
 class Module:
     """ Encapsulates all of the logic for manipulating a module """
 
-    def __init__(self,modulefile):
-        """ Initializes a module from a modulefile """
+    def __init__(self,modulefile=None,name=None):
+        """
+        Initializes a module from a modulefile, or an empty module that
+        ModuleDb.lookup() fills in from the database.
+        """
 
-        self.name = os.path.basename(modulefile)
+        self.versions = []
+        self.actions = {}
+        self.data = {}
+        self.paths = {}
+        if modulefile:
+            self.parse(modulefile,name)
+
+
+    def parse(self,modulefile,name=None):
+        """
+        Reads the versions, actions and data from a modulefile, named after
+        the modulefile unless a name is given.
+        """
+
+        import ConfigParser
+
+        self.name = name or os.path.basename(modulefile)
         self.defaults = defaults.copy()
         self.defaults['name'] = self.name
 
@@ -70,11 +90,6 @@ class Module:
             raise ModuleError("no versions specified in '%s'" % modulefile)
         self.default_version = config.get(sections[0],'version');
 
-        self.versions = []
-        self.actions = {}
-        self.data = {}
-        self.paths = {}
-
         for section in sections:
 
             version = config.get(section,'version')
@@ -90,9 +105,7 @@ class Module:
                     if key.partition(' ')[0] in ('set', 'append', 'prepend'):
                         if '"' in val:
                             raise ModuleError("found illegal '\"' character in action for '%s':\n  %s = %s" % (modulefile,key,val)) 
-                        self.actions[version].append((key,val))
-                        if key.partition(' ')[2] == 'PATH':
-                            self.paths[version] += val.split(':')
+                        self.add_action(version,key,val)
                     else:
                         self.data[version][key] = val
 
@@ -101,7 +114,15 @@ class Module:
                         "error interpreting modulefile '%s'\n  %s" % (
                         modulefile, str(e)))
 
-        self.versions.sort()
+        self.versions.sort(key=version_key)
+
+
+    def add_action(self,version,key,val):
+        """ Adds an action to a version, and tracks the paths it adds to PATH """
+
+        self.actions[version].append((key,val))
+        if key.partition(' ')[2] == 'PATH':
+            self.paths[version] += val.split(':')
 
 
     def help(self,version=None):
@@ -113,7 +134,12 @@ class Module:
             '\nVersions: ', ', '.join(self.versions), \
             '\nDefault:  ', self.default_version, \
             '\nURL:      ', self.data[version].get('url', ''), \
-            '\nBrief:    ', self.data[version].get('brief', ''), \
+            '\nBrief:    ', self.data[version].get('brief', ''),
+        for key,title in (('requires', '\nRequires: '),
+                          ('conflicts', '\nConflicts:')):
+            if key in self.data[version]:
+                print >>sys.stderr, title, self.data[version][key],
+        print >>sys.stderr, \
             '\n\n', self.data[version].get('usage', '')
         if 'loadmsg' in self.data[version]:
             print >>sys.stderr, \
@@ -136,6 +162,7 @@ class Module:
     def load(self,env,version=None):
         """ Loads this module and modifies the caller's environment """
 
+        start = time.time()
         self.unload(env)
 
         version = self.__pick_version(version)
@@ -153,6 +180,7 @@ class Module:
             elif action[0] == 'prepend': env.prepend(action[1],val)
 
         env.append(LOADEDMODULES,'/'.join([self.name,version]))
+        record_usage('/'.join([self.name,version]), time.time() - start)
 
 
     def unload(self,env,strict=False):
@@ -181,21 +209,52 @@ class Module:
         env.remove(LOADEDMODULES,'/'.join([self.name,version]))
 
 
-    def list_bin(self,version):
-        """ List the executables provided by the module. """
+    def list_bin(self,version,index=None):
+        """ List the executables provided by the module """
 
-        version = self.__pick_version(version)
+        for path,programs in self.bin_directories(version,index):
+            print >>sys.stderr, "%s:" % path
+            print_columns(programs)
 
-        # Lambda function tests if a path is an executable file
-        is_exe = lambda f: os.path.isfile(f) and os.access(f, os.X_OK)
+
+    def bin_directories(self,version,index=None):
+        """
+        Yields the directories in the PATH of the module that have
+        executables, and the sorted executables in each, from the index of
+        directories returned by ModuleDb.lookup_files() when they are in it.
+        """
+
+        version = self.__pick_version(version)
 
         for path in self.paths[version]:
             path = localize(path)
-            os.chdir(path)
-            programs = filter(is_exe, os.listdir(path))
+            if index is not None and path in index:
+                programs = index[path]
+            else:
+                programs = [f for f,exe in _scan(path)[1] if exe]
             if programs:
-                print >>sys.stderr, "%s:" % path
-                print_columns(sorted(programs))
+                yield path,sorted(programs)
+
+
+    def describe(self,version=None):
+        """
+        Returns a record of a version of this module, with its data and its
+        actions, for machine-readable output.
+        """
+
+        version = self.__pick_version(version)
+        actions = []
+        for key,val in self.actions[version]:
+            action,_,variable = key.partition(' ')
+            actions.append({'action': action, 'variable': variable,
+                            'value': val, 'localized': localize(val)})
+        return {'module': '/'.join([self.name,version]),
+                'name': self.name,
+                'version': version,
+                'versions': self.versions,
+                'default': version == self.default_version,
+                'data': self.data[version],
+                'actions': actions}
 
 
     def __pick_version(self,version):
@@ -213,29 +272,474 @@ class Module:
     def __pick_loaded(self):
         """ Picks the version of the module based on the loaded modules """
 
-        moduleids = os.getenv(LOADEDMODULES)
-        if moduleids:
-            for moduleid in moduleids.split(':'):
-                name,version = splitid(moduleid)
-                if name == self.name:
-                    return version
+        return loaded_version(self.name)
+
+
+def loaded_version(name):
+    """ Returns the version of the named module that is currently loaded """
+
+    moduleids = os.getenv(LOADEDMODULES)
+    if moduleids:
+        for moduleid in moduleids.split(':'):
+            loaded,version = splitid(moduleid)
+            if loaded == name:
+                return version
+    return None
+
+
+def loaded_modules():
+    """ Returns a dictionary of the versions of the loaded modules by name """
+
+    moduleids = os.getenv(LOADEDMODULES)
+    if not moduleids:
+        return {}
+    return dict(map(splitid, moduleids.split(':')))
+
+
+def visible_scopes(loaded):
+    """
+    Returns the scopes whose modules are visible: the top level, and the
+    scope of each loaded module version.
+    """
+
+    return [''] + ['/'.join(moduleid) for moduleid in loaded.iteritems()]
+
+
+def qualify_loaded(moduleids,loaded):
+    """
+    Returns the module ids with the name of each one that is loaded from
+    the scope of another module replaced by its full name.
+    """
+
+    qualified = []
+    for moduleid in moduleids:
+        name,version = splitid(moduleid)
+        if name not in loaded:
+            for full in loaded:
+                if full.rpartition('/')[2] == name:
+                    name = full
+                    break
+        qualified.append('/'.join((name,version)) if version else name)
+    return qualified
+
+
+def resolve(moduleids,dependencies,loaded):
+    """
+    Returns the module ids to load for a request, in order, with the
+    requirements of each module before it, unless they are already loaded or
+    requested. The dependencies are the (graph, defaults) returned by
+    ModuleDb.dependencies(), and loaded is the dictionary returned by
+    loaded_modules().
+
+    Raises a ModuleError if a module requires a module that isn't in the
+    database or a different version of a requested module, if requirements
+    are circular, or if any module to load conflicts with another module
+    that is loaded or will be.
+    """
+
+    graph, defaults = dependencies
+    requested = [(name, version or defaults.get(name, ''))
+                 for name,version in map(splitid, moduleids)]
+    if not graph:
+        return moduleids
+
+    order = []
+    chosen = dict(requested)
+    visiting = []
+
+    def visit(name,version):
+        if (name,version) in order:
+            return
+        if (name,version) in visiting:
+            raise ModuleError("circular requirement: %s" % ' -> '.join(
+                '/'.join(moduleid) for moduleid in
+                visiting[visiting.index((name,version)):] + [(name,version)]))
+        visiting.append((name,version))
+        # Choose the requirements on specific versions first, so that they
+        # also satisfy any requirement on the same module by name only.
+        edges = sorted(graph.get((name,version), ()), key=lambda e: not e[2])
+        for kind,target,target_version in edges:
+            if kind != 'requires':
+                continue
+            current = chosen.get(target) or loaded.get(target)
+            if current and target_version in ('', current):
+                if target in chosen:
+                    visit(target,chosen[target])
+                continue
+            if target in chosen:
+                raise ModuleError("'%s/%s' requires '%s/%s', not '%s/%s'" % (
+                    name, version, target, target_version, target, current))
+            # Every module in the database that is a requirement has a
+            # default version.
+            if target not in defaults:
+                raise ModuleError("'%s/%s' requires unknown module '%s'" % (
+                    name, version, target))
+            chosen[target] = target_version or defaults.get(target, '')
+            visit(target,chosen[target])
+        visiting.pop()
+        order.append((name,version))
+
+    for name,version in requested:
+        visit(name,version)
+
+    check_conflicts(chosen,graph,loaded)
+
+    return ['/'.join(moduleid) if moduleid[1] else moduleid[0]
+            for moduleid in order]
+
+
+def check_conflicts(chosen,graph,loaded):
+    """
+    Raises a ModuleError if any of the modules to load, in a dictionary of
+    versions by name, conflicts with another one or with a loaded module
+    that will stay loaded, or the other way around. The graph is the first
+    result of ModuleDb.dependencies().
+    """
+
+    modules = dict(loaded)
+    modules.update(chosen)
+    for name,version in modules.iteritems():
+        for kind,target,target_version in graph.get((name,version), ()):
+            if kind != 'conflicts' or (name not in chosen and
+                                       target not in chosen):
+                continue
+            current = modules.get(target)
+            if current and target_version in ('', current):
+                raise ModuleError("'%s/%s' conflicts with '%s/%s'" % (
+                    name, version, target, current))
+
+
+def compile_delta(modules):
+    """
+    Returns the messages and the changes to each environment variable for
+    loading a list of (Module, version) pairs into an environment where
+    none of them are loaded.
+
+    Each change is either a (value, None, None) to set the variable, or a
+    (None, prepend, append) with the paths to add around its current value.
+    Paths are not localized, so the changes apply on any node.
+    """
+
+    messages = []
+    deltas = {}
+
+    def splice(variable, val, front):
+        value, prepend, append = deltas.get(variable, (None, [], []))
+        paths = val.split(':')
+        if value is not None:
+            # Edit the value of a variable that was set.
+            value = [x for x in value.split(':') if x not in paths]
+            value = ':'.join(paths + value if front else value + paths)
+        else:
+            prepend = [x for x in prepend if x not in paths]
+            append = [x for x in append if x not in paths]
+            if front: prepend = paths + prepend
+            else: append += paths
+        deltas[variable] = (value, prepend, append)
+
+    for module,version in modules:
+        messages.append("module: loading '%s/%s'" % (module.name, version))
+        if 'loadmsg' in module.data[version]:
+            messages.append("module: %s: %s" % (
+                            module.name, module.data[version]['loadmsg']))
+        for key,val in module.actions[version]:
+            action = key.split(' ',1)
+            if action[0] == 'set': deltas[action[1]] = (val, None, None)
+            elif action[0] == 'append': splice(action[1], val, False)
+            elif action[0] == 'prepend': splice(action[1], val, True)
+        splice(LOADEDMODULES, '/'.join([module.name,version]), False)
+
+    for variable, (value, prepend, append) in deltas.items():
+        if value is None:
+            deltas[variable] = (None, ':'.join(prepend), ':'.join(append))
+    return '\n'.join(messages), deltas
+
+
+def _fileinfo(modulefile):
+    """ Returns the mtime, size and SHA-1 hash of a modulefile """
+
+    import hashlib
+
+    st = os.stat(modulefile)
+    f = open(modulefile, 'rb')
+    try:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+    return st.st_mtime, st.st_size, digest
+
+
+def _modulename(path,modulefile):
+    """
+    Returns the name of a modulefile in the directory path. A modulefile in a
+    `<name>.d/<version>` directory is in the scope of that module version,
+    which prefixes its name: `gcc.d/4.8/hdf5` is named `gcc/4.8/hdf5`.
+    """
+
+    parts = os.path.relpath(modulefile, path).split(os.sep)
+    scopes = parts[:-1]
+    if len(scopes) % 2 or '..' in scopes or \
+       not all(scope.endswith('.d') for scope in scopes[::2]):
+        return os.path.basename(modulefile)
+    for i in range(0, len(scopes), 2):
+        scopes[i] = scopes[i][:-2]
+    return '/'.join(scopes + parts[-1:])
+
+
+def _modulefiles(path):
+    """
+    Returns the sorted paths of the modulefiles in the directory path and in
+    its scope directories, skipping hidden files.
+    """
+
+    modulefiles = []
+    for dirpath,dirnames,filenames in os.walk(path):
+        depth = os.path.relpath(dirpath, path).count(os.sep)
+        if dirpath != path:
+            depth += 1
+        # Scope directories alternate between `<name>.d` and `<version>`.
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')
+                       and (depth % 2 or d.endswith('.d'))]
+        if depth % 2 == 0:
+            modulefiles += [os.path.join(dirpath, f) for f in filenames
+                            if not f.startswith('.')]
+    return sorted(modulefiles)
+
+
+def _parse(item):
+    """
+    Returns the Module parsed from a (modulefile, name), or the ModuleError,
+    with the modulefile's info.
+    """
+
+    modulefile,name = item
+    try:
+        info = _fileinfo(modulefile)
+        return Module(modulefile,name), info
+    except (IOError, OSError) as e:
+        return ModuleError("can't read modulefile '%s': %s" % (
+                           modulefile, e.strerror)), None
+    except ModuleError as e:
+        return e, None
+
+
+def _mtime(path):
+    """ Returns the mtime of a path, or None if it can't be stat'ed """
+
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
         return None
 
 
+def _bundles():
+    """ Returns the contents of the bundles file, or '' if there is none """
+
+    try:
+        f = open(MODULEBUNDLES)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except IOError:
+        return ''
+
+
+def _scan(directory):
+    """
+    Returns the mtime of a directory and a (file, executable) pair for each
+    file in it, or a None mtime if the directory can't be read.
+    """
+
+    try:
+        mtime = os.stat(directory).st_mtime
+        files = []
+        for f in os.listdir(directory):
+            path = os.path.join(directory,f)
+            files.append((f, os.path.isfile(path) and os.access(path, os.X_OK)))
+    except OSError:
+        return None, []
+    return mtime, files
+
+
+def _module_directories(module,version):
+    """
+    Returns the set of directories that a version of a Module adds to the
+    INDEXPATHS variables, in every localization that can be enumerated.
+    """
+
+    directories = set()
+    for key,val in module.actions[version]:
+        if key.partition(' ')[2] in INDEXPATHS:
+            for path in val.split(':'):
+                directories.update(localizations(path))
+    return directories
+
+
+def _directories(modules):
+    """ Returns the set of indexed directories of a list of Modules """
+
+    directories = set()
+    for module in modules:
+        for version in module.versions:
+            directories |= _module_directories(module,version)
+    return directories
+
+
+def _map(func,items,jobs=None):
+    """
+    Maps func over a list of items with a pool of `jobs` processes (by
+    default, one per CPU).
+    """
+
+    import multiprocessing
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1 and len(items) > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.map(func, items)
+        pool.close()
+        pool.join()
+        return results
+    else:
+        return map(func, items)
+
+
+def _parse_all(path,modulefiles,jobs=None):
+    """
+    Parses a list of modulefiles in the directory path with a pool of `jobs`
+    processes (by default, one per CPU), and returns the (modulefile, Module,
+    info) for each one that parsed without errors.
+    """
+
+    results = _map(_parse, [(modulefile, _modulename(path, modulefile))
+                            for modulefile in modulefiles], jobs)
+
+    parsed = []
+    for modulefile,(result,info) in zip(modulefiles,results):
+        if isinstance(result,ModuleError):
+            result.warn()
+        else:
+            parsed.append((modulefile,result,info))
+    return parsed
+
+
+def _generation(dbfile):
+    """
+    Returns the generation of a database, which is incremented each time the
+    live database is replaced, or 0 if it has none.
+    """
+
+    if not os.path.exists(dbfile):
+        return 0
+    try:
+        conn = sqlite.connect(dbfile)
+        try:
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        finally:
+            conn.close()
+    except sqlite.DatabaseError:
+        return 0
+    if row: return int(row[0])
+    else: return 0
+
+
+def _limit(limit):
+    """ Returns the SQL LIMIT for an optional limit, where -1 is none """
+
+    return -1 if limit is None else limit
+
+
+def _prefix_range(prefix):
+    """
+    Returns the bounds of the strings that start with a prefix, ignoring the
+    case of ASCII letters like LIKE does. SQLite can't use an index for a
+    LIKE with a bound parameter, but it can for a range on a NOCASE column.
+    """
+
+    if isinstance(prefix, str):
+        prefix = prefix.decode('utf-8', 'replace')
+    # NOCASE compares ASCII letters in lower case, and nothing else.
+    prefix = ''.join(c.lower() if c < u'\x80' else c for c in prefix)
+    return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+def _copyfile(src,dst):
+    """ Copies src to dst through a temporary file, so dst is never partial """
+
+    import shutil
+
+    tmpfile = '%s.%d' % (dst, os.getpid())
+    shutil.copyfile(src, tmpfile)
+    os.rename(tmpfile, dst)
+
+
+def _locked(method):
+    """
+    Decorates a ModuleDb method that writes the database, so that it holds an
+    exclusive lock on the lock file next to the database while it runs.
+    """
+
+    def locked(self,*args,**kwargs):
+        import fcntl
+
+        lockfile = MODULEDB + '.lock'
+        fd = os.open(lockfile, os.O_WRONLY | os.O_CREAT, moduleperm)
+        try:
+            # Let the other administrators take the lock, like the database.
+            if os.fstat(fd).st_uid == os.getuid():
+                os.fchmod(fd, moduleperm)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                info("waiting for lock on '%s'" % lockfile)
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+            return method(self,*args,**kwargs)
+        finally:
+            os.close(fd)
+
+    locked.__name__ = method.__name__
+    locked.__doc__ = method.__doc__
+    return locked
+
+
 class ModuleDb:
-    """ Encapsulates the database of modules """
+    """
+    Encapsulates the database of modules.
 
-    def __init__(self):
+    The live database is never written in place: writers hold a lock, write
+    a copy, and rename it over the live database, so readers always see a
+    complete database without waiting on any lock. A readonly ModuleDb also
+    refuses to write, and reads the node-local replica of the database if
+    there is one.
+    """
+
+    def __init__(self,readonly=False):
         self.conn = None
+        self.readonly = readonly
         self.connect()
 
 
-    def connect(self, dbfile=MODULEDB):
+    def dbfile(self):
+        """ Returns the database file to connect to by default """
+
+        if self.readonly and trusted(MODULELOCALDB):
+            return MODULELOCALDB
+        return MODULEDB
+
+
+    def connect(self, dbfile=None):
         """ Initializes connections to the sqlite database """
+        if dbfile is None:
+            dbfile = self.dbfile()
         try:
             if self.conn:
                 self.conn.close()
             self.conn = sqlite.connect(dbfile, isolation_level=None)
+            if self.readonly:
+                self.conn.execute("PRAGMA query_only = ON")
         except sqlite.OperationalError as e:
             raise ModuleError(
                 "can't connect to database '%s' (sqlite3 error: %s)" % (
@@ -243,138 +747,1226 @@ class ModuleDb:
         self.conn.row_factory = sqlite.Row
 
 
-    def rebuild(self,path):
-        """ Rebuilds the database with the modulefiles in the path """
+    def create(self,dbfile):
+        """ Creates an empty database with the current schema in dbfile """
 
-        # Since rebuild can take some time, write the new database to a
-        # temporary path to prevent service interruption.
-        tmpfile = MODULEDB + '~'
-        if os.path.exists(tmpfile):
-            os.unlink(tmpfile)
+        if os.path.exists(dbfile):
+            os.unlink(dbfile)
 
-        self.connect(tmpfile)
+        self.connect(dbfile)
 
         self.conn.execute("""
             CREATE TABLE modules (
                 name TEXT PRIMARY KEY,
-                data BLOB)""")
+                default_version TEXT)""")
 
         self.conn.execute("""
             CREATE TABLE moduleids (
                 name TEXT,
                 version TEXT,
+                sort_key TEXT,
+                is_default INTEGER,
                 PRIMARY KEY (name,version))""")
 
+        self.conn.execute("""
+            CREATE TABLE actions (
+                name TEXT,
+                version TEXT,
+                seq INTEGER,
+                action TEXT,
+                variable TEXT,
+                value TEXT,
+                PRIMARY KEY (name,version,seq))""")
+
+        self.conn.execute("""
+            CREATE TABLE data (
+                name TEXT,
+                version TEXT,
+                key TEXT,
+                value TEXT,
+                PRIMARY KEY (name,version,key))""")
+
         self.conn.execute("""
             CREATE TABLE categories (
                 category TEXT,
                 name TEXT,
                 version TEXT,
+                sort_key TEXT,
                 PRIMARY KEY (category,name,version))""")
 
-        for modulefile in os.listdir(path):
-            if not modulefile.startswith('.'):
-                self.insert(os.path.join(path,modulefile))
+        # Allow the case-insensitive prefix matches in avail() to use indexes.
+        self.conn.execute("""
+            CREATE INDEX moduleids_name
+            ON moduleids (name COLLATE NOCASE)""")
+        self.conn.execute("""
+            CREATE INDEX categories_category
+            ON categories (category COLLATE NOCASE)""")
+
+        # List the versions of each module in natural order from an index.
+        self.conn.execute("""
+            CREATE INDEX moduleids_order
+            ON moduleids (name,sort_key,version)""")
+        self.conn.execute("""
+            CREATE INDEX categories_order
+            ON categories (category,name,sort_key,version)""")
+
+        self.conn.execute("""
+            CREATE TABLE directories (
+                directory TEXT PRIMARY KEY,
+                mtime REAL)""")
+
+        self.conn.execute("""
+            CREATE TABLE files (
+                directory TEXT,
+                file TEXT,
+                executable INTEGER,
+                PRIMARY KEY (directory,file))""")
+        self.conn.execute("""
+            CREATE INDEX files_file
+            ON files (file)""")
+
+        self.conn.execute("""
+            CREATE TABLE visibility (
+                scope TEXT,
+                alias TEXT,
+                name TEXT,
+                depth INTEGER,
+                PRIMARY KEY (scope,alias))""")
+
+        self.conn.execute("""
+            CREATE TABLE dependencies (
+                name TEXT,
+                version TEXT,
+                kind TEXT,
+                target TEXT,
+                target_version TEXT,
+                PRIMARY KEY (name,version,kind,target))""")
+
+        self.conn.execute("""
+            CREATE TABLE moduledirs (
+                directory TEXT,
+                name TEXT,
+                version TEXT,
+                PRIMARY KEY (directory,name,version))""")
+
+        self.conn.execute("""
+            CREATE TABLE bundles (
+                bundle TEXT PRIMARY KEY,
+                names TEXT,
+                messages TEXT)""")
+
+        self.conn.execute("""
+            CREATE TABLE deltas (
+                bundle TEXT,
+                variable TEXT,
+                value TEXT,
+                prepend TEXT,
+                append TEXT,
+                PRIMARY KEY (bundle,variable))""")
+
+        self.conn.execute("""
+            CREATE TABLE meta (
+                key TEXT PRIMARY KEY,
+                value TEXT)""")
+
+        # Use the best full-text index that this version of SQLite supports,
+        # or fall back to a plain table that is scanned by search().
+        for kind,using in (
+                ('trigram', "fts5(%s, tokenize='trigram')"),
+                ('fts5', "fts5(%s)"),
+                ('fts4', "fts4(%s)")):
+            try:
+                self.conn.execute(
+                    "CREATE VIRTUAL TABLE search USING " + using % \
+                    "name, version, category, brief, usage")
+                break
+            except sqlite.OperationalError:
+                pass
+        else:
+            kind = ''
+            self.conn.execute("""
+                CREATE TABLE search (
+                    name TEXT,
+                    version TEXT,
+                    category TEXT,
+                    brief TEXT,
+                    usage TEXT)""")
+        self.conn.execute(
+            "INSERT INTO meta VALUES ('search',?)", (kind,))
+
+        self.conn.execute("""
+            CREATE TABLE modulefiles (
+                name TEXT PRIMARY KEY,
+                path TEXT,
+                mtime REAL,
+                size INTEGER,
+                hash TEXT)""")
+
+        self.conn.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+
+    def check_schema(self):
+        """ Raises an error if the database has an older schema """
+
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            raise ModuleError(
+                "database '%s' has schema version %d instead of %d\n"
+                "  run 'moduledb rebuild' to update it" % (
+                MODULEDB, version, SCHEMA_VERSION))
+
+
+    def get_meta(self,key,default=None):
+        """ Returns a value from the meta table of the database """
+
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row: return row[0]
+        else: return default
+
+
+    def copy(self):
+        """
+        Copies the live database to a temporary file and connects to the copy,
+        to be moved in place with publish() or removed with discard().
+        """
+
+        import shutil
+
+        tmpfile = MODULEDB + '~'
+        shutil.copyfile(MODULEDB, tmpfile)
+        self.connect(tmpfile)
+        return tmpfile
+
+
+    def discard(self,dbfile):
+        """ Removes the copy of the database in dbfile and reconnects """
 
-        # Move temporary database in place ...
         self.conn.close()
+        os.unlink(dbfile)
+        self.connect()
+
+
+    def publish(self,dbfile):
+        """
+        Moves the database in dbfile in place of the live database, as its
+        next generation.
+        """
+
+        self.conn.execute(
+            "REPLACE INTO meta VALUES ('generation',?)",
+            (str(_generation(MODULEDB) + 1),))
+        self.conn.close()
+        os.chmod(dbfile, moduleperm)
+        os.rename(dbfile, MODULEDB)
+
+        # Reestablish the connection.
+        self.connect()
+        self.write_completion()
+
+
+    def write_completion(self):
+        """
+        Writes the sorted list of module ids used for tab completion, which
+        modulecmd can search without opening the database.
+        """
+
+        cursor = self.conn.execute("SELECT name, version FROM moduleids")
+        moduleids = sorted(map('/'.join, cursor))
+
+        tmpfile = MODULECOMPLETION + '~'
+        f = open(tmpfile, 'w')
+        try:
+            for moduleid in moduleids:
+                print >>f, moduleid
+        finally:
+            f.close()
+        os.chmod(tmpfile, moduleperm)
+        os.rename(tmpfile, MODULECOMPLETION)
+
+
+    @_locked
+    def snapshot(self):
+        """
+        Copies the live database and completion file to immutable snapshots
+        named by the database's generation, for nodes to pull, and removes
+        all but the previous snapshot.
+        """
+
+        self.check_schema()
+        generation = self.get_meta('generation','0')
+
+        if not os.path.isdir(MODULESNAPSHOTS):
+            os.mkdir(MODULESNAPSHOTS)
+            os.chmod(MODULESNAPSHOTS, 0775)
+        current = os.path.join(MODULESNAPSHOTS, 'current')
+        try:
+            previous = open(current).read().strip()
+        except IOError:
+            previous = None
+
+        for src,dst in ((MODULEDB, 'db.%s.sqlite'),
+                        (MODULECOMPLETION, 'completion.%s')):
+            dst = os.path.join(MODULESNAPSHOTS, dst % generation)
+            _copyfile(src, dst)
+            os.chmod(dst, moduleperm)
+
+        tmpfile = '%s.%d' % (current, os.getpid())
+        f = open(tmpfile, 'w')
+        try:
+            print >>f, generation
+        finally:
+            f.close()
         os.chmod(tmpfile, moduleperm)
-        os.rename(tmpfile, MODULEDB)
+        os.rename(tmpfile, current)
+
+        # Keep the previous snapshot for nodes that are still copying it.
+        keep = ('current', 'db.%s.sqlite' % generation,
+                'completion.%s' % generation)
+        if previous:
+            keep += ('db.%s.sqlite' % previous, 'completion.%s' % previous)
+        for name in os.listdir(MODULESNAPSHOTS):
+            if name not in keep:
+                os.unlink(os.path.join(MODULESNAPSHOTS, name))
+        return generation
+
+
+    def pull(self):
+        """
+        Copies the current snapshot to the node-local replica, if the replica
+        is from an older generation. Returns the generation that was pulled,
+        or None if the replica was already current.
+        """
 
-        # ... and reestablish the connection.
+        try:
+            generation = open(
+                os.path.join(MODULESNAPSHOTS, 'current')).read().strip()
+        except IOError:
+            raise ModuleError(
+                "no snapshot of database '%s' to pull: run 'moduledb publish'" % \
+                MODULEDB)
+        if generation == str(_generation(MODULELOCALDB)) and \
+           os.path.exists(MODULELOCALCOMPLETION):
+            return None
+
+        try:
+            make_localdir(replicadir,0755)
+            _copyfile(
+                os.path.join(MODULESNAPSHOTS, 'completion.%s' % generation),
+                MODULELOCALCOMPLETION)
+            _copyfile(
+                os.path.join(MODULESNAPSHOTS, 'db.%s.sqlite' % generation),
+                MODULELOCALDB)
+            # Replicas that others can write are ignored by trusted().
+            for replica in (MODULELOCALCOMPLETION, MODULELOCALDB):
+                os.chmod(replica, 0644)
+        except (IOError, OSError) as e:
+            raise ModuleError(
+                "can't pull generation %s of database '%s': %s" % (
+                generation, MODULEDB, e.strerror))
         self.connect()
+        return generation
+
+
+    @_locked
+    def merge_usage(self,spools):
+        """
+        Merges the records of module loads in the usage spool files into the
+        usage statistics, and removes the spool files. Returns the number of
+        records that were merged.
+        """
+
+        # Each spool is moved aside first, so that commands loading modules
+        # in the meantime start a new spool.
+        stats = {}
+        merged = []
+        for spool in spools:
+            tmpfile = '%s.%d' % (spool, os.getpid())
+            try:
+                os.rename(spool, tmpfile)
+                f = open(tmpfile)
+                try:
+                    lines = f.read().splitlines()
+                finally:
+                    f.close()
+            except (IOError, OSError) as e:
+                ModuleError("can't read usage spool '%s': %s" % (
+                            spool, e.strerror)).warn()
+                continue
+            merged.append(tmpfile)
+            for line in lines:
+                try:
+                    timestamp,user,host,moduleid,latency = line.split('\t')
+                    timestamp,latency = float(timestamp),float(latency)
+                except ValueError:
+                    continue # A partially written record.
+                loads,total,first,last = stats.get((moduleid,user,host),
+                                                   (0,0.0,timestamp,timestamp))
+                stats[moduleid,user,host] = (loads + 1, total + latency,
+                                             min(first,timestamp),
+                                             max(last,timestamp))
+
+        try:
+            conn = sqlite.connect(MODULEUSAGE, isolation_level=None)
+            try:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS usage (
+                        moduleid TEXT,
+                        user TEXT,
+                        host TEXT,
+                        loads INTEGER,
+                        latency REAL,
+                        first REAL,
+                        last REAL,
+                        PRIMARY KEY (moduleid, user, host))""")
+                conn.execute('BEGIN')
+                for (moduleid,user,host),(loads,latency,first,last) in \
+                    stats.iteritems():
+                    if not conn.execute("""
+                        UPDATE usage
+                        SET loads = loads + ?, latency = latency + ?,
+                            first = MIN(first, ?), last = MAX(last, ?)
+                        WHERE moduleid = ? AND user = ? AND host = ?""",
+                        (loads,latency,first,last,moduleid,user,host)
+                        ).rowcount:
+                        conn.execute("""
+                            INSERT INTO usage VALUES (?,?,?,?,?,?,?)""",
+                            (moduleid,user,host,loads,latency,first,last))
+                conn.execute('COMMIT')
+            finally:
+                conn.close()
+        except sqlite.Error as e:
+            raise ModuleError(
+                "can't merge usage into '%s' (sqlite3 error: %s)" % (
+                MODULEUSAGE, e))
+        if os.stat(MODULEUSAGE).st_uid == os.getuid():
+            os.chmod(MODULEUSAGE, moduleperm)
+
+        for tmpfile in merged:
+            os.unlink(tmpfile)
+        return sum(loads for loads,_,_,_ in stats.itervalues())
+
+
+    def usage(self):
+        """
+        Returns the usage statistics of each module id, including the ones
+        in the database that were never loaded, as (moduleid, loads, users,
+        hosts, mean latency, last load) tuples, most loaded first.
+        """
+
+        stats = {}
+        if os.path.exists(MODULEUSAGE):
+            conn = sqlite.connect(MODULEUSAGE)
+            try:
+                stats = dict((row[0], tuple(row[1:])) for row in conn.execute("""
+                    SELECT moduleid, SUM(loads), COUNT(DISTINCT user),
+                           COUNT(DISTINCT host), SUM(latency) / SUM(loads),
+                           MAX(last)
+                    FROM usage
+                    GROUP BY moduleid"""))
+            except sqlite.Error as e:
+                raise ModuleError(
+                    "can't read usage from '%s' (sqlite3 error: %s)" % (
+                    MODULEUSAGE, e))
+            finally:
+                conn.close()
+        for moduleid in self.avail():
+            stats.setdefault(moduleid, (0, 0, 0, None, None))
+        return sorted(((moduleid,) + row for moduleid,row in stats.iteritems()),
+                      key=lambda row: (-row[1], row[0]))
+
+
+    @_locked
+    def rebuild(self,path,jobs=None):
+        """
+        Rebuilds the database with the modulefiles in the path, parsing them
+        with a pool of `jobs` processes (by default, one per CPU).
+        """
+
+        path = os.path.abspath(path)
+        parsed = _parse_all(path,_modulefiles(path),jobs)
+
+        # Since rebuild can take some time, write the new database to a
+        # temporary path to prevent service interruption.
+        tmpfile = MODULEDB + '~'
+        self.create(tmpfile)
+
+        modules = [module for _,module,_ in parsed]
+
+        self.conn.execute('BEGIN')
+        self.add(modules)
+        for modulefile,module,info in parsed:
+            self.record(module.name,modulefile,info)
+        self.index(_directories(modules),jobs)
+        self.compile_bundles()
+        self.conn.execute('COMMIT')
+
+        for modulefile,_,_ in parsed:
+            os.chmod(modulefile, moduleperm)
+
+        self.publish(tmpfile)
+
+
+    @_locked
+    def sync(self,path,jobs=None):
+        """
+        Updates the database with only the modulefiles in the path that were
+        added, changed or deleted since they were last inserted, according to
+        their mtime, size and hash. Returns the number of modulefiles added,
+        changed and deleted.
+        """
+
+        path = os.path.abspath(path)
+
+        self.check_schema()
+        cursor = self.conn.execute("""
+            SELECT name, path, mtime, size, hash
+            FROM modulefiles""")
+        records = dict((row[0], tuple(row)[1:]) for row in cursor)
+
+        listed = [(_modulename(path,modulefile),modulefile)
+                  for modulefile in _modulefiles(path)]
+
+        modulefiles = []
+        touched = []
+        for name,modulefile in listed:
+            record = records.get(name)
+            if record and record[0] == modulefile:
+                st = os.stat(modulefile)
+                if (st.st_mtime, st.st_size) == record[1:3]:
+                    continue
+                info = _fileinfo(modulefile)
+                if info[2] == record[3]:
+                    touched.append((name,modulefile,info))
+                    continue
+            modulefiles.append(modulefile)
+
+        listed = set(name for name,_ in listed)
+        deleted = [name for name,record in records.iteritems()
+                   if record[0].startswith(os.path.join(path,''))
+                   and name not in listed]
+
+        # A modulefile that fails to parse keeps its old rows, and is
+        # retried on the next sync.
+        parsed = _parse_all(path,modulefiles,jobs)
+
+        # Rescan the directories of changed modules, and any indexed
+        # directory whose mtime changed.
+        directories = _directories([module for _,module,_ in parsed])
+        for directory,mtime in self.conn.execute(
+                "SELECT directory, mtime FROM directories"):
+            if _mtime(directory) != mtime:
+                directories.add(directory)
+
+        # Leave the database and its generation alone if nothing changed, so
+        # that replicas and saved collections stay current.
+        bundles = _bundles().decode('utf-8','replace') != \
+                  self.get_meta('bundles')
+        if not (deleted or parsed or touched or directories or bundles):
+            return 0, 0, 0
+
+        tmpfile = self.copy()
+
+        self.conn.execute('BEGIN')
+        for name in deleted:
+            self.delete(name)
+        for _,module,_ in parsed:
+            self.delete(module.name)
+        self.add([module for _,module,_ in parsed])
+        for modulefile,module,info in parsed:
+            self.record(module.name,modulefile,info)
+        for name,modulefile,info in touched:
+            self.record(name,modulefile,info)
+        self.index(directories,jobs)
+        # The bundles are compiled from the modules' actions.
+        if deleted or parsed or bundles:
+            self.compile_bundles()
+        self.conn.execute('COMMIT')
+
+        self.publish(tmpfile)
+
+        for modulefile,_,_ in parsed:
+            os.chmod(modulefile, moduleperm)
+
+        changed = len([m for _,m,_ in parsed if m.name in records])
+        return len(parsed) - changed, changed, len(deleted)
+
+
+    @_locked
+    def migrate(self):
+        """
+        Converts a database of pickled modules, from before modules were
+        stored as rows, to the current schema.
+        """
+
+        import pickle
+
+        # Databases stored as rows start at schema version 2.
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= 2:
+            raise ModuleError(
+                "database '%s' has no pickled modules to migrate" % MODULEDB)
 
+        cursor = self.conn.execute("SELECT data FROM modules")
+        modules = [pickle.loads(str(row['data'])) for row in cursor]
 
+        tmpfile = MODULEDB + '~'
+        self.create(tmpfile)
+
+        self.conn.execute('BEGIN')
+        self.add(modules)
+        self.index(_directories(modules))
+        self.compile_bundles()
+        self.conn.execute('COMMIT')
+
+        self.publish(tmpfile)
+
+
+    @_locked
     def insert(self,modulefile,force=False):
         """ Inserts the modulefile as a Module into the database """
 
+        self.check_schema()
+
         try:
-            module = Module(modulefile)
+            info = _fileinfo(modulefile)
+            module = Module(modulefile,
+                            _modulename(MODULEPATH,os.path.abspath(modulefile)))
+        except (IOError, OSError) as e:
+            ModuleError("can't read modulefile '%s': %s" % (
+                        modulefile, e.strerror)).warn()
+            return
         except ModuleError as e:
             e.warn()
             return
 
-        blob = sqlite.Binary(pickle.dumps(module,pickle.HIGHEST_PROTOCOL))
+        tmpfile = self.copy()
 
         self.conn.execute('BEGIN')
 
         if force:
-            self.conn.execute(
-                "REPLACE INTO modules VALUES (?,?)",
-                (module.name,blob))
-            self.conn.execute(
-                "DELETE FROM moduleids WHERE name = ?",
-                (module.name,))
-            self.conn.execute(
-                "DELETE FROM categories WHERE name = ?",
-                (module.name,))
-        else:
-            try:
-                self.conn.execute(
-                    "INSERT INTO modules VALUES (?,?)",
-                    (module.name,blob))
-            except sqlite.IntegrityError:
-                raise ModuleError(
-                        "duplicate module already in database for '%s'" % \
-                        module.name)
+            self.delete(module.name)
         
-        for version in module.versions:
-            self.conn.execute(
-                "INSERT INTO moduleids VALUES (?,?)",
-                (module.name,version))
-            for category in module.data[version].get('category', '(none)').split(','):
-                self.conn.execute(
-                    "INSERT INTO categories VALUES (?,?,?)",
-                    (category,module.name,version))
-            
+        try:
+            self.add([module])
+        except sqlite.IntegrityError:
+            self.conn.execute('ROLLBACK')
+            self.discard(tmpfile)
+            raise ModuleError(
+                    "duplicate module already in database for '%s'" % \
+                    module.name)
+        self.record(module.name,os.path.abspath(modulefile),info)
+        self.index(_directories([module]),1)
+
+        self.compile_bundles()
         self.conn.execute('COMMIT')
 
+        self.publish(tmpfile)
+
         os.chmod(modulefile, moduleperm)
 
 
-    def lookup(self,name):
-        """ Return the module with the specified name from the database """
+    def add(self,modules):
+        """ Writes the rows for a list of Modules into the database """
+
+        ids = [(m,version) for m in modules for version in m.versions]
+
+        def actions():
+            for m,version in ids:
+                for seq,(key,val) in enumerate(m.actions[version]):
+                    action,_,variable = key.partition(' ')
+                    yield m.name,version,seq,action,variable,val
+
+        def data():
+            for m,version in ids:
+                for key,val in m.data[version].iteritems():
+                    yield m.name,version,key,val
+
+        def categories():
+            for m,version in ids:
+                for category in m.data[version].get('category', '(none)').split(','):
+                    yield category,m.name,version,version_key(version)
+
+        def visibility():
+            for m in modules:
+                scope,_,alias = m.name.rpartition('/')
+                yield scope,alias,m.name,len(scope.split('/')) if scope else 0
+
+        def dependencies():
+            for m,version in ids:
+                # A module requires the module version whose scope it is in.
+                scope = m.name.rpartition('/')[0]
+                if scope:
+                    yield (m.name,version,'requires') + splitid(scope)
+                for kind in ('requires', 'conflicts'):
+                    for moduleid in m.data[version].get(kind, '').split():
+                        yield (m.name,version,kind) + splitid(moduleid)
+
+        def directories():
+            for m,version in ids:
+                for directory in _module_directories(m,version):
+                    yield directory,m.name,version
+
+        def search():
+            for m,version in ids:
+                data = m.data[version]
+                yield (m.name,version,data.get('category', ''),
+                       data.get('brief', ''),data.get('usage', ''))
+
+        self.conn.executemany(
+            "INSERT INTO modules VALUES (?,?)",
+            ((m.name,m.default_version) for m in modules))
+        self.conn.executemany(
+            "INSERT INTO moduleids VALUES (?,?,?,?)",
+            ((m.name,version,version_key(version),version == m.default_version)
+             for m,version in ids))
+        self.conn.executemany(
+            "INSERT INTO actions VALUES (?,?,?,?,?,?)", actions())
+        self.conn.executemany(
+            "INSERT INTO data VALUES (?,?,?,?)", data())
+        self.conn.executemany(
+            "INSERT INTO categories VALUES (?,?,?,?)", categories())
+        self.conn.executemany(
+            "INSERT INTO visibility VALUES (?,?,?,?)", visibility())
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO dependencies VALUES (?,?,?,?,?)",
+            dependencies())
+        self.conn.executemany(
+            "INSERT INTO moduledirs VALUES (?,?,?)", directories())
+        self.conn.executemany(
+            "INSERT INTO search VALUES (?,?,?,?,?)", search())
+
+
+    def index(self,directories,jobs=None):
+        """
+        Scans directories into the index of files, with a pool of `jobs`
+        processes (by default, one per CPU).
+        """
+
+        directories = sorted(directories)
+        for directory,(mtime,files) in zip(
+                directories,_map(_scan,directories,jobs)):
+            self.conn.execute(
+                "DELETE FROM files WHERE directory = ?", (directory,))
+            self.conn.execute(
+                "REPLACE INTO directories VALUES (?,?)", (directory,mtime))
+            self.conn.executemany(
+                "INSERT INTO files VALUES (?,?,?)",
+                ((directory,f,exe) for f,exe in files))
+
+
+    def lookup_files(self,directories):
+        """
+        Return a dictionary of the executables in each of the directories
+        that is in the index.
+        """
+
+        if not directories:
+            return {}
+        try:
+            cursor = self.conn.execute("""
+                SELECT directory, file, executable
+                FROM directories LEFT JOIN files USING (directory)
+                WHERE directory IN (%s)
+                ORDER BY directory, file""" % ','.join('?'*len(directories)),
+                list(directories))
+        except sqlite.OperationalError:
+            return {}
+        index = {}
+        for directory,f,exe in cursor:
+            programs = index.setdefault(directory, [])
+            if exe:
+                programs.append(f)
+        return index
+
+
+    def provides(self,pattern):
+        """
+        Return the (file, moduleid, directory) of every indexed file that
+        matches the glob pattern.
+        """
+
+        try:
+            cursor = self.conn.execute("""
+                SELECT file, name || '/' || version, directory
+                FROM files JOIN moduledirs USING (directory)
+                WHERE file GLOB ?
+                ORDER BY file, name, version""", (pattern,))
+            return cursor.fetchall()
+        except sqlite.OperationalError as e:
+            raise ModuleError(
+                "can't read database '%s' (sqlite3 error: %s)\n"
+                "  run 'moduledb rebuild' to update it" % (MODULEDB, e))
+
+
+    def qualify(self,moduleids,loaded):
+        """
+        Return the module ids with each name replaced by the full name of the
+        module it refers to in the deepest visible scope, given the loaded
+        modules and the modules before it in the list.
+        """
+
+        scopes = set(visible_scopes(loaded))
+        qualified = []
+        for moduleid in moduleids:
+            name,version = splitid(moduleid)
+            try:
+                row = self.conn.execute("""
+                    SELECT name, default_version
+                    FROM visibility JOIN modules USING (name)
+                    WHERE alias = ? AND scope IN (%s)
+                    ORDER BY depth DESC
+                    LIMIT 1""" % ','.join('?'*len(scopes)),
+                    [name] + list(scopes)).fetchone()
+            except sqlite.OperationalError:
+                return moduleids
+            if row:
+                name = row[0]
+                scopes.add('/'.join((name, version or row[1])))
+            qualified.append('/'.join((name,version)) if version else name)
+        return qualified
+
+
+    def dependencies(self):
+        """
+        Return the graph of requirements and conflicts between modules, as a
+        dictionary from each (name, version) that has any to a list of
+        (kind, name, version), where the version is empty for any version.
+        Also return a dictionary of the default versions of the modules in
+        the graph. The default version of a module is also in the graph with
+        an empty version.
+        """
+
+        try:
+            cursor = self.conn.execute("""
+                SELECT d.name, d.version, s.default_version,
+                       d.kind, d.target, d.target_version, t.default_version
+                FROM dependencies d
+                JOIN modules s ON s.name = d.name
+                LEFT JOIN modules t ON t.name = d.target""")
+        except sqlite.OperationalError:
+            return {}, {}
+        graph = {}
+        defaults = {}
+        for name,version,default,kind,target,target_version,target_default \
+                in cursor:
+            graph.setdefault((name,version), []).append(
+                (kind,target,target_version))
+            defaults[name] = default
+            if target_default is not None:
+                defaults[target] = target_default
+        return graph, defaults
+
+
+    def compile_bundles(self):
+        """
+        Compiles the environment changes for loading each bundle of modules
+        listed in the bundles file, one bundle per line.
+        """
+
+        self.conn.execute("DELETE FROM bundles")
+        self.conn.execute("DELETE FROM deltas")
+
+        # Keep the bundles file, so that sync() can tell when it changes.
+        text = _bundles()
+        self.conn.execute("REPLACE INTO meta VALUES ('bundles',?)",
+                          (text.decode('utf-8','replace'),))
+        lines = text.splitlines()
+
+        dependencies = self.dependencies()
+        for line in lines:
+            moduleids = line.partition('#')[0].split()
+            if not moduleids:
+                continue
+            bundle = ' '.join(moduleids)
+            try:
+                moduleids = resolve(moduleids, dependencies, {})
+                modules = []
+                lookup = self.lookup_many(map(splitid, moduleids))
+                for name,version in map(splitid, moduleids):
+                    if name not in lookup:
+                        raise ModuleError("unknown module '%s'" % name)
+                    module = lookup[name]
+                    version = version or module.default_version
+                    if version not in module.versions:
+                        raise ModuleError(
+                            "unknown version '%s/%s'" % (name, version))
+                    modules.append((module,version))
+            except ModuleError as e:
+                ModuleError("skipping bundle '%s': %s" % (
+                            bundle, e)).warn()
+                continue
+
+            messages, deltas = compile_delta(modules)
+            self.conn.execute(
+                "INSERT INTO bundles VALUES (?,?,?)",
+                (bundle, ':'.join(m.name for m,_ in modules), messages))
+            self.conn.executemany(
+                "INSERT INTO deltas VALUES (?,?,?,?,?)",
+                ((bundle,variable) + delta
+                 for variable,delta in deltas.iteritems()))
+
+
+    def lookup_bundle(self,moduleids):
+        """
+        Return the messages and the compiled environment changes for loading
+        a list of module ids, or None if they aren't a compiled bundle, any
+        of their modules is already loaded, or any of them conflicts with a
+        loaded module.
+        """
+
+        bundle = ' '.join(moduleids)
+        try:
+            row = self.conn.execute(
+                "SELECT names, messages FROM bundles WHERE bundle = ?",
+                (bundle,)).fetchone()
+        except sqlite.OperationalError:
+            return None
+        if not row:
+            return None
+        for name in row[0].split(':'):
+            if loaded_version(name):
+                return None
 
         cursor = self.conn.execute("""
-            SELECT name, data
-            FROM modules
-            WHERE name = ?""",(name,))
+            SELECT variable, value, prepend, append
+            FROM deltas
+            WHERE bundle = ?""", (bundle,))
+        deltas = [tuple(delta) for delta in cursor]
+        for variable,value,prepend,append in deltas:
+            if variable == LOADEDMODULES and \
+               self.conflicts(((prepend or '') + ':' + (append or '')).split(':')):
+                return None
+        return row[1], deltas
+
+
+    def conflicts(self,moduleids):
+        """
+        Return whether any of the module ids, with versions, conflicts with
+        a loaded module, or the other way around.
+        """
+
+        loaded = loaded_modules()
+        if not loaded:
+            return False
+        chosen = dict(splitid(moduleid) for moduleid in moduleids if moduleid)
+        try:
+            check_conflicts(chosen,self.dependencies()[0],loaded)
+        except ModuleError:
+            return True
+        return False
+
 
-        result = cursor.fetchone()
-        if result: return pickle.loads(str(result['data']))
-        else: raise ModuleError("unknown module '%s'" % name, 'unknown')
+    def record(self,name,modulefile,info):
+        """ Records the path, mtime, size and hash of a module's modulefile """
+
+        self.conn.execute(
+            "REPLACE INTO modulefiles VALUES (?,?,?,?,?)",
+            (name,modulefile) + info)
+
+
+    def delete(self,name):
+        """ Deletes all rows for the named module from the database """
+
+        for table in ('modules', 'moduleids', 'actions', 'data', 'categories',
+                      'modulefiles', 'visibility', 'dependencies', 'moduledirs',
+                      'search'):
+            self.conn.execute(
+                "DELETE FROM %s WHERE name = ?" % table,
+                (name,))
 
 
-    def avail(self,name='',version=''):
-        """ Return a list of the modules in the database matching the
-            specified name and version. """
+    def lookup(self,name,version=''):
+        """
+        Return the module with the specified name from the database.
+
+        Only the actions and data of the requested version (or the default
+        version) and of the currently loaded version are read. If version is
+        None, all versions are read.
+        """
+
+        modules = self.lookup_many([(name,version)])
+        if name not in modules:
+            raise ModuleError("unknown module '%s'" % name, 'unknown')
+        return modules[name]
+
+
+    def lookup_many(self,moduleids):
+        """
+        Return a dictionary of the modules with the names in a list of
+        (name, version) pairs, reading all of them with one query per table.
+        Names that aren't in the database are left out.
+
+        As for lookup(), only the requested and loaded versions are read.
+        """
+
+        requested = {}
+        for name,version in moduleids:
+            if version is None or requested.get(name, '') is None:
+                requested[name] = None
+            else:
+                requested.setdefault(name, set()).add(version)
+        if not requested:
+            return {}
+
+        try:
+            cursor = self.conn.execute("""
+                SELECT name, version, is_default
+                FROM moduleids
+                WHERE name IN (%s)
+                ORDER BY name, sort_key""" % ','.join('?'*len(requested)),
+                requested.keys())
+
+            modules = {}
+            for row in cursor:
+                module = modules.get(row[0])
+                if not module:
+                    module = modules[row[0]] = Module()
+                    module.name = row[0]
+                module.versions.append(row[1])
+                if row[2]:
+                    module.default_version = row[1]
+
+            # Select the rows of the versions needed from each module.
+            where = []
+            params = []
+            for name,module in modules.iteritems():
+                versions = requested[name]
+                if versions is None:
+                    versions = module.versions
+                    where.append("name = ?")
+                    params.append(name)
+                else:
+                    versions = set(v or module.default_version
+                                   for v in versions)
+                    versions.add(loaded_version(name))
+                    versions = [v for v in module.versions if v in versions]
+                    where.append("(name = ? AND version IN (%s))" % \
+                                 ','.join('?'*len(versions)))
+                    params += [name] + versions
+                for v in versions:
+                    module.actions[v] = []
+                    module.data[v] = {}
+                    module.paths[v] = []
+            if not modules:
+                return modules
+            where = ' OR '.join(where)
+
+            cursor = self.conn.execute("""
+                SELECT name, version, action, variable, value
+                FROM actions
+                WHERE %s
+                ORDER BY name, version, seq""" % where, params)
+            for row in cursor:
+                modules[row[0]].add_action(row[1],row[2]+' '+row[3],row[4])
+
+            cursor = self.conn.execute("""
+                SELECT name, version, key, value
+                FROM data
+                WHERE %s""" % where, params)
+            for row in cursor:
+                modules[row[0]].data[row[1]][row[2]] = row[3]
+
+        except sqlite.OperationalError as e:
+            raise ModuleError(
+                "can't read database '%s' (sqlite3 error: %s)\n"
+                "  run 'moduledb migrate' or 'moduledb rebuild' to update it" % (
+                MODULEDB, e))
+
+        return modules
+
+
+    def describe_many(self,moduleids,batch=500):
+        """
+        Return an iterator over records of the module ids, with their name,
+        version, categories and whether they are the default version, looking
+        them up in batches as the module ids are read.
+        """
+
+        moduleids = iter(moduleids)
+        while True:
+            batch_ids = list(itertools.islice(moduleids,batch))
+            if not batch_ids:
+                return
+            names = list(set(splitid(moduleid)[0] for moduleid in batch_ids))
+            cursor = self.conn.execute("""
+                SELECT name, version, is_default, category
+                FROM moduleids JOIN categories USING (name,version)
+                WHERE name IN (%s)
+                ORDER BY category""" % ','.join('?'*len(names)), names)
+            categories = {}
+            defaults = set()
+            for row in cursor:
+                if row[2]:
+                    defaults.add((row[0],row[1]))
+                categories.setdefault((row[0],row[1]),[]).append(row[3])
+            for moduleid in batch_ids:
+                name,version = splitid(moduleid)
+                yield {'module': moduleid,
+                       'name': name,
+                       'version': version,
+                       'default': (name,version) in defaults,
+                       'categories': categories.get((name,version),[])}
+
+
+    def avail(self,name='',version='',scopes=None,limit=None,offset=0):
+        """ Return an iterator over the modules in the database matching the
+            specified name and version, in the scopes if any are given, as
+            they are read from the database. """
+
+        where = ["version LIKE ?"]
+        params = ['%'+version+'%']
+        if scopes is None:
+            tables = "moduleids"
+            column = "name"
+        else:
+            tables = "visibility JOIN moduleids USING (name)"
+            column = "alias"
+            where.append("scope IN (%s)" % ','.join('?'*len(scopes)))
+            params += list(scopes)
+        # Without a name, all modules are read in order from an index.
+        if name:
+            where.append("%s >= ? COLLATE NOCASE AND %s < ? COLLATE NOCASE" % (
+                         column, column))
+            params += _prefix_range(name)
 
         cursor = self.conn.execute("""
             SELECT name, version
-            FROM moduleids
-            WHERE name LIKE ? AND version LIKE ?
-            ORDER BY name """,
-            (name+'%','%'+version+'%'))
-        return map('/'.join, cursor)
-
+            FROM %s
+            WHERE %s
+            ORDER BY name, sort_key
+            LIMIT ? OFFSET ? """ % (tables, ' AND '.join(where)),
+            params + [_limit(limit),offset])
+        return itertools.imap('/'.join, cursor)
+
+
+    def search(self,terms,limit=None,offset=0):
+        """
+        Return an iterator over the modules whose name, version, category,
+        brief description or usage contain all of the terms, best matches
+        first.
+        """
+
+        kind = self.get_meta('search','')
+        if kind == 'trigram':
+            # Trigrams can only match terms of at least three characters.
+            indexed = min(len(term) for term in terms) >= 3
+            fmt = '"%s"'
+        else:
+            indexed = bool(kind)
+            fmt = '"%s"*'
 
-    def avail_category(self,category=''):
-        """ Return a list of modules organized by category. """
+        if indexed:
+            if kind == 'fts4':
+                order = 'name, version'
+            else:
+                order = 'bm25(search), name, version'
+            query = ' '.join(fmt % term.replace('"','""') for term in terms)
+            cursor = self.conn.execute("""
+                SELECT name, version
+                FROM search
+                WHERE search MATCH ?
+                ORDER BY %s
+                LIMIT ? OFFSET ?""" % order, (query,_limit(limit),offset))
+        else:
+            where = ' AND '.join(
+                ["(name||' '||version||' '||category||' '||brief||' '||usage)"
+                 " LIKE ?"] * len(terms))
+            cursor = self.conn.execute("""
+                SELECT name, version
+                FROM search
+                WHERE %s
+                ORDER BY name, version
+                LIMIT ? OFFSET ?""" % where,
+                ['%'+term+'%' for term in terms] + [_limit(limit),offset])
+        return itertools.imap('/'.join, cursor)
+
+
+    def suggest(self,name,n=5):
+        """ Return up to n module names that are close matches to name """
+
+        import difflib
+
+        names = dict((row[0].lower(), row[0]) for row in
+                     self.conn.execute("SELECT name FROM modules"))
+        matches = difflib.get_close_matches(name.lower(), names.keys(), n)
+        return [names[match] for match in matches]
+
+
+    def avail_category(self,category='',scopes=None,limit=None,offset=0):
+        """ Return an iterator over the (category, module) pairs of the
+            categories, in the scopes if any are given, in order of
+            category. """
+
+        where = []
+        params = []
+        # Without a category, all categories are read in order from an index.
+        if category:
+            where.append(
+                "category >= ? COLLATE NOCASE AND category < ? COLLATE NOCASE")
+            params += _prefix_range(category)
+        # The scopes are a subquery, so that the categories are looked up
+        # by their index instead of once for each visible module.
+        if scopes is not None:
+            where.append("name IN (SELECT name FROM visibility WHERE scope IN (%s))"
+                         % ','.join('?'*len(scopes)))
+            params += list(scopes)
 
         cursor = self.conn.execute("""
             SELECT category, name, version
             FROM categories
-            WHERE category LIKE ? 
-            ORDER BY category, name """,
-            (category+'%',))
-        category = None
-        matches = []
-        for row in cursor:
-            if row[0] != category:
-                category = row[0]
-                matches.append((category, []))
-            matches[-1][1].append(row[1]+'/'+row[2])
-        return matches
+            %s
+            ORDER BY category, name, sort_key
+            LIMIT ? OFFSET ? """ % (
+            'WHERE ' + ' AND '.join(where) if where else ''),
+            params + [_limit(limit),offset])
+        return ((row[0], row[1]+'/'+row[2]) for row in cursor)
+
+
+class PathList:
+    """
+    An ordered list of unique paths, from a colon-separated environment
+    variable, that can be prepended, appended and removed in constant time.
+    """
+
+    def __init__(self,value=None):
+        # Map each path to its position: prepended paths get decreasing
+        # positions and appended paths increasing ones, so the order is
+        # only sorted out when the list is joined.
+        self._positions = {}
+        self._first = 0
+        self._last = -1
+        if value:
+            # The first occurrence of a duplicate path keeps its precedence.
+            for path in value.split(':'):
+                if path not in self._positions:
+                    self.append(path)
+
+
+    def prepend(self,path):
+        """ Moves or adds the path to the front of the list """
+
+        self._first -= 1
+        self._positions[path] = self._first
+
+
+    def append(self,path):
+        """ Moves or adds the path to the end of the list """
+
+        self._last += 1
+        self._positions[path] = self._last
+
+
+    def remove(self,path):
+        """ Removes the path from the list, if it is there """
+
+        self._positions.pop(path,None)
+
+
+    def join(self):
+        """ Returns the colon-separated string of the paths in order """
+
+        return ':'.join(sorted(self._positions, key=self._positions.get))
 
 
 class ModuleEnv:
@@ -383,20 +1975,26 @@ class ModuleEnv:
     def __init__(self):
         self._env = dict()
         self._env_unset = set()
+        self._paths = dict()
 
 
     def get(self,variable):
         """ Gets an environment variable from the cache """
 
+        if variable in self._paths:
+            return self._value(variable,self._paths[variable].join())
         try:
             return self._env[variable]
         except KeyError:
             return os.getenv(variable)
 
 
-    def dump(self,out=sys.stdout):
+    def dump(self,out=None):
         """ Prints the environment variable cache line by line """
 
+        if out is None:
+            out = sys.stdout
+
         if MODULESHELL == 'bash':
             unsetfmt = "unset {0};"
             setfmt = "export {0}=\"{1}\";"
@@ -406,18 +2004,56 @@ class ModuleEnv:
         else:
             raise NotImplementedError(MODULESHELL)
 
+        # Path lists are only joined into strings here.
+        for var,paths in self._paths.iteritems():
+            self._env[var] = self._value(var,paths.join())
+        self._paths.clear()
+
         for var in self._env_unset:
             print >>out, unsetfmt.format(var)
         for var,val in self._env.iteritems():
             print >>out, setfmt.format(var,val)
 
 
+    def cache_localization(self):
+        """
+        Exports the localization table of this node if it had to be loaded,
+        so that later commands in the same shell can skip loading it.
+        """
+
+        value = localization()
+        if value:
+            self._env[MODULELOCALIZATION] = value
+
+
+    def apply(self,deltas):
+        """
+        Applies the environment changes compiled by compile_delta(), as
+        (variable, value, prepend, append) tuples.
+        """
+
+        for variable,value,prepend,append in deltas:
+            if value is not None:
+                self.set(variable,value)
+            else:
+                self.splice(variable,prepend,append)
+
+
+    def splice(self,variable,prepend,append):
+        """
+        Prepends and appends colon-separated lists of paths to the
+        environment variable at once
+        """
+
+        if prepend: self.prepend(variable,prepend)
+        if append: self.append(variable,append)
+
+
     def set(self,variable,value):
         """ Sets the environment variable to the specified value """
 
-        if variable == 'MANPATH' and (not value or value[-1] != ':'):
-            value += ':'
-        self._env[variable] = localize(value)
+        self._paths.pop(variable,None)
+        self._env[variable] = self._value(variable,localize(value))
 
 
     def unset(self,variable,value=None):
@@ -428,45 +2064,45 @@ class ModuleEnv:
 
 
     def append(self,variable,path):
-        """ Appends the path to the environment variable """
+        """ Appends the path, or colon-separated paths, to the variable """
 
-        path = localize(path)
-        paths = self.get(variable)
-        if not paths:
-            paths = path
-        else:
-            paths = paths.split(':')
-            paths = [x for x in paths if x != path]
+        paths = self._pathlist(variable)
+        for path in localize(path).split(':'):
             paths.append(path)
-            paths = ':'.join(paths)
-        self.set(variable,paths)
 
 
     def prepend(self,variable,path):
-        """ Prepends the path to the environment variable """
+        """ Prepends the path, or colon-separated paths, to the variable """
 
-        path = localize(path)
-        paths = self.get(variable)
-        if not paths:
-            paths = path
-        else:
-            paths = paths.split(':')
-            paths = [x for x in paths if x != path]
-            paths.insert(0,path)
-            paths = ':'.join(paths)
-        self.set(variable,paths)
+        paths = self._pathlist(variable)
+        for path in reversed(localize(path).split(':')):
+            paths.prepend(path)
 
 
     def remove(self,variable,path):
-        """ Removes the path from the environment variable """
-
-        path = localize(path)
-        paths = self.get(variable)
-        if paths:
-            paths = paths.split(':')
-            paths = [x for x in paths if x != path]
-            paths = ':'.join(paths)
-            self.set(variable,paths)
+        """ Removes the path, or colon-separated paths, from the variable """
+
+        if variable in self._paths or self.get(variable):
+            paths = self._pathlist(variable)
+            for path in localize(path).split(':'):
+                paths.remove(path)
+
+
+    def _pathlist(self,variable):
+        """ Returns the path list for the variable, starting from its value """
+
+        if variable not in self._paths:
+            self._paths[variable] = PathList(self.get(variable))
+        return self._paths[variable]
+
+
+    def _value(self,variable,value):
+        """ Returns the value to export for the variable """
+
+        # A trailing colon keeps the system's default search path in MANPATH.
+        if variable == 'MANPATH' and (not value or value[-1] != ':'):
+            value += ':'
+        return value
 
 
 # vim:ts=4:shiftwidth=4:expandtab:
@@ -23,6 +23,7 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 
+import binascii
 import os
 
 ### MODIFY THESE ###
@@ -37,6 +38,20 @@ rootdir = '/gpfs/runtime/opt/'
 # database. NOTE: you must include the leading 0 in the octal code!
 moduleperm = 0664
 
+# A directory on local disk or tmpfs on each node, where PyModules caches
+# information about the node.
+localdir = '/tmp/pymodules'
+
+# A directory on local disk on each node, where `moduledb pull` keeps a
+# replica of the database. It must be owned by root (or the owner of the
+# database) and not writable by anyone else, or the replica is ignored.
+replicadir = '/var/lib/pymodules'
+
+# A directory on local disk or tmpfs on each node, where module commands
+# spool a record of each module they load, for `moduledb usage` to merge
+# into usage statistics. Set it to None to not record usage.
+usagedir = None
+
 ### DO NOT EDIT BELOW ###
 
 # Default data.
@@ -53,10 +68,44 @@ messages = {
   with this module name should be installed."""
 }
 
+# Database.
+
+SCHEMA_VERSION = 10
+
+# Path variables whose directories are indexed, for `module bin` and
+# `module provides`.
+INDEXPATHS = ('PATH', 'LD_LIBRARY_PATH', 'LIBRARY_PATH', 'CPATH',
+              'C_INCLUDE_PATH', 'CPLUS_INCLUDE_PATH')
+
 # Environment variables.
 
 MODULEPATH = os.environ['MODULEPATH']
 MODULEDB = os.path.join(MODULEPATH, '.db.sqlite')
+MODULECOMPLETION = os.path.join(MODULEPATH, '.completion')
+MODULEBUNDLES = os.path.join(MODULEPATH, '.bundles')
 MODULESHELL = os.environ['MODULESHELL']
 LOADEDMODULES = 'LOADEDMODULES'
+MODULELOCALIZATION = 'MODULELOCALIZATION'
+MODULESOCKET = os.environ.get('MODULESOCKET')
+
+# Profiling of module commands: set MODULE_PROFILE to 1 to print the time of
+# each phase of a command to stderr, or to a file to append them as JSON.
+MODULEPROFILE = 'MODULE_PROFILE'
+
+# Saved collections of modules, in the home directory of the user who runs
+# the command.
+MODULECOLLECTIONS = os.path.join('~', '.pymodules')
+
+# Profiles of modules to load at login, first for the site then the user.
+MODULEPROFILES = (os.path.join(MODULEPATH, '.modules'),
+                  os.path.join('~', '.modules'))
+
+# Published snapshots of the database, and their node-local replicas.
+MODULESNAPSHOTS = os.path.join(MODULEPATH, '.snapshots')
+_replica = '%08x' % (binascii.crc32(MODULEDB) & 0xffffffff)
+MODULELOCALDB = os.path.join(replicadir, 'db.%s.sqlite' % _replica)
+MODULELOCALCOMPLETION = os.path.join(replicadir, 'completion.%s' % _replica)
+
+# Usage statistics merged from the spools in usagedir.
+MODULEUSAGE = os.path.join(MODULEPATH, '.usage.sqlite')
 
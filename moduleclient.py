@@ -0,0 +1,95 @@
+#
+# PyModules - Software Environments for Research Computing Clusters
+#
+# Copyright 2012-2013, Brown University, Providence, RI. All Rights Reserved.
+#
+# This file is part of PyModules.
+#
+# Permission to use, copy, modify, and distribute this software and its
+# documentation for any purpose other than its incorporation into a
+# commercial product is hereby granted without fee, provided that the
+# above copyright notice appear in all copies and that both that
+# copyright notice and this permission notice appear in supporting
+# documentation, and that the name of Brown University not be used in
+# advertising or publicity pertaining to distribution of the software
+# without specific, written prior permission.
+#
+# BROWN UNIVERSITY DISCLAIMS ALL WARRANTIES WITH REGARD TO THIS SOFTWARE,
+# INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR ANY
+# PARTICULAR PURPOSE.  IN NO EVENT SHALL BROWN UNIVERSITY BE LIABLE FOR
+# ANY SPECIAL, INDIRECT OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+
+import json
+import os
+import socket
+import sys
+
+
+def request(argv):
+    """
+    Send the command line and environment to the module server listening on
+    `MODULESOCKET`, and return its reply, or None if there is no server.
+    """
+
+    path = os.environ.get('MODULESOCKET')
+    if not path or not os.path.exists(path):
+        return None
+
+    # Collections and profiles are in the user's home directory, so those
+    # commands run in the user's own process.
+    if argv and argv[0] in ('save', 'restore', 'init'):
+        return None
+
+    try:
+        message = json.dumps({
+            'argv': argv,
+            'environ': dict(os.environ),
+            'shell': os.environ.get('MODULESHELL')})
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(10)
+        sock.connect(path)
+        sock.sendall(message)
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        sock.close()
+        reply = json.loads(''.join(chunks))
+    except (socket.error, ValueError):
+        return None
+
+    # The server declines requests it can't answer, e.g. for another shell.
+    if reply.get('status') is None:
+        return None
+    return reply
+
+
+def main():
+
+    reply = request(sys.argv[1:])
+    if reply is None:
+        # Fall back to running the command in this process.
+        import modulecmd
+        modulecmd.main()
+    else:
+        sys.stdout.write(reply['stdout'].encode('utf-8'))
+        sys.stderr.write(reply['stderr'].encode('utf-8'))
+        sys.exit(reply['status'])
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ts=4:shiftwidth=4:expandtab:
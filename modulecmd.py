@@ -23,13 +23,55 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 
-import argparse
 import sys
 import os
+import time
 
-from module import ModuleError, Module, ModuleDb, ModuleEnv
-from modulecfg import LOADEDMODULES
-from moduleutil import splitid, print_centered, print_columns
+# The subcommands import the rest of PyModules as they need it, so that the
+# commands run at every prompt, like `module list`, don't load the database.
+from modulecfg import LOADEDMODULES, MODULECOMPLETION, MODULELOCALCOMPLETION
+from modulecfg import MODULECOLLECTIONS, MODULEPROFILES, MODULESHELL
+from modulecfg import MODULEPROFILE
+from moduleutil import splitid, print_centered, print_columns, info
+from moduleutil import prefix_matches, record_usage, flush_usage, Profile
+from moduleutil import trusted
+
+_profile = None
+
+
+def _moduledb(args):
+    """
+    Return the database connection passed in by the caller, or open one.
+    """
+
+    from module import ModuleDb
+
+    if not args.moduledb:
+        args.moduledb = ModuleDb(readonly=True)
+    return args.moduledb
+
+
+def _lookup_many(args,versions=True):
+    """
+    Look up all of the modules in the arguments at once, and yield each
+    module with its requested version, warning about unknown modules.
+    """
+
+    from module import ModuleError
+
+    moduleids = map(splitid, args.module)
+    if not versions:
+        moduleids = [(name,'') for name,_ in moduleids]
+    try:
+        modules = _moduledb(args).lookup_many(moduleids)
+    except ModuleError as e:
+        e.warn()
+        return
+    for name,version in moduleids:
+        if name in modules:
+            yield modules[name],version
+        else:
+            ModuleError("unknown module '%s'" % name, 'unknown').warn()
 
 
 def avail(args):
@@ -37,21 +79,101 @@ def avail(args):
     List available modules.
     """
 
-    moduledb = ModuleDb()
+    import itertools
+    from module import loaded_modules, visible_scopes
+
+    moduledb = _moduledb(args)
+    pages = {'limit': args.limit, 'offset': args.offset}
+    if args.search:
+        if args.module:
+            _print_title(args, 'search: ' + ' '.join(args.module))
+            matches = moduledb.search(args.module, **pages)
+            if not _print_matches(args, matches):
+                _suggest(args, moduledb, args.module)
+        return
     if not args.module:
         args.module = [':']
+    scopes = visible_scopes(loaded_modules())
     for moduleid in args.module:
         name,version = splitid(moduleid)
         if name.startswith(':'):
-            for category, matches in moduledb.avail_category(name[1:]):
-                print_centered('category: ' + category)
-                print_columns(matches)
+            matches = moduledb.avail_category(name[1:],scopes,**pages)
+            for category, rows in itertools.groupby(matches, lambda r: r[0]):
+                _print_title(args, 'category: ' + category)
+                _print_matches(args, (moduleid for _,moduleid in rows))
         else:
             title = 'name: %s*/*' % name
             if version:
                 title = '%s%s*' % (title, version)
-            print_centered(title)
-            print_columns(moduledb.avail(name,version))
+            _print_title(args, title)
+            matches = moduledb.avail(name,version,scopes,**pages)
+            if not _print_matches(args, matches):
+                _suggest(args, moduledb, [name])
+
+
+def _print_title(args, title):
+    """
+    Print the title of a list of modules, unless the output is terse or JSON.
+    """
+
+    if not args.terse and not args.json:
+        print_centered(title)
+
+
+def _print_matches(args, moduleids):
+    """
+    Print module ids as they are read, in columns, one per line if the
+    output is terse, or as JSON records, and return the number printed.
+    """
+
+    if args.json:
+        return _print_json(_moduledb(args).describe_many(moduleids))
+    if not args.terse:
+        return print_columns(moduleids)
+    count = 0
+    for moduleid in moduleids:
+        print >>sys.stderr, moduleid
+        count += 1
+    return count
+
+
+def _suggest(args, moduledb, names):
+    """
+    Print the names of modules that are close matches to the names, unless
+    the output is terse or starts past the first match.
+    """
+
+    if args.terse or args.json or args.offset:
+        return
+    suggestions = []
+    for name in names:
+        suggestions += [s for s in moduledb.suggest(name)
+                        if s not in suggestions]
+    if suggestions:
+        info("did you mean: %s?" % ', '.join(suggestions))
+
+
+def _print_json(records):
+    """
+    Print records to stdout as they are read, one JSON object per line, and
+    return the number printed.
+    """
+
+    import errno
+    import json
+
+    count = 0
+    try:
+        for record in records:
+            print json.dumps(record, sort_keys=True)
+            count += 1
+        sys.stdout.flush()
+    except IOError as e:
+        # The reader can stop reading early, like `head`.
+        if e.errno != errno.EPIPE:
+            raise
+        sys.stdout = open(os.devnull, 'w')
+    return count
 
 
 def list_loaded(args):
@@ -64,6 +186,12 @@ def list_loaded(args):
         return
 
     moduleids = [m for m in moduleids.split(':') if m]
+    if args.json:
+        _print_json({'module': moduleid,
+                     'name': splitid(moduleid)[0],
+                     'version': splitid(moduleid)[1]}
+                    for moduleid in moduleids)
+        return
     print_columns(moduleids)
 
 
@@ -73,15 +201,93 @@ def load(args):
     aliases: add switch swap
     """
 
+    from module import ModuleEnv
+
     env = ModuleEnv()
-    db = ModuleDb()
-    for moduleid in args.module:
-        name,version = splitid(moduleid)
+    _load(args,env)
+    env.cache_localization()
+    env.dump()
+
+
+def _load(args,env):
+    """
+    Load the modules in the arguments, and their requirements, into env.
+    """
+
+    from module import ModuleError, Module, resolve, loaded_modules
+
+    # Loading the modules one after the other would leave only the last
+    # version of each name loaded, as when the profiles' loads run in turn.
+    last = dict((splitid(moduleid)[0], i)
+                for i,moduleid in enumerate(args.module))
+    args.module = [moduleid for i,moduleid in enumerate(args.module)
+                   if last[splitid(moduleid)[0]] == i]
+
+    moduledb = _moduledb(args)
+    bundle = moduledb.lookup_bundle(args.module)
+    if bundle:
+        messages, deltas = bundle
+        print >>sys.stderr, messages
+        _apply(env,deltas)
+    else:
+        # Add the modules' requirements, in the order they must be loaded.
+        loaded = loaded_modules()
         try:
-            Module.load(db.lookup(name),env,version)
+            args.module = resolve(moduledb.qualify(args.module, loaded),
+                                  moduledb.dependencies(), loaded)
         except ModuleError as e:
             e.warn()
-    env.dump()
+            args.module = []
+        modules = list(_lookup_many(args))
+        _unload_scoped(args,env,
+            ['/'.join((module.name,loaded[module.name]))
+             for module,version in modules if module.name in loaded and
+             loaded[module.name] != (version or module.default_version)])
+        for module,version in modules:
+            try:
+                Module.load(module,env,version)
+            except ModuleError as e:
+                e.warn()
+
+
+def _unload_scoped(args,env,scopes,keep=()):
+    """
+    Unload the loaded modules in the scopes of module versions that are
+    being unloaded or switched, innermost first, since they would no longer
+    be visible. Modules named in keep are left to the caller.
+    """
+
+    from module import Module, loaded_modules
+
+    if not scopes:
+        return
+    loaded = loaded_modules()
+    names = [name for name in loaded if name not in keep and
+             any(name.startswith(scope + '/') for scope in scopes)]
+    if not names:
+        return
+    modules = _moduledb(args).lookup_many(
+        [(name,loaded[name]) for name in names])
+    for name in sorted(names, reverse=True):
+        if name in modules:
+            Module.unload(modules[name],env)
+
+
+def _apply(env,deltas):
+    """
+    Apply the compiled changes for loading a bundle or collection to env,
+    recording the usage of each module in it.
+    """
+
+    start = time.time()
+    env.apply(deltas)
+    latency = time.time() - start
+    for variable,value,prepend,append in deltas:
+        if variable == LOADEDMODULES:
+            moduleids = [m for m in (prepend or '').split(':') +
+                                    (append or '').split(':') if m]
+            for moduleid in moduleids:
+                record_usage(moduleid, latency / len(moduleids))
 
 
 def unload(args):
@@ -90,14 +296,23 @@ def unload(args):
     aliases: rm remove
     """
 
+    from module import ModuleError, Module, ModuleEnv
+    from module import loaded_modules, qualify_loaded
+
     env = ModuleEnv()
-    db = ModuleDb()
-    for moduleid in args.module:
-        name,version = splitid(moduleid)
+    loaded = loaded_modules()
+    args.module = qualify_loaded(args.module, loaded)
+    modules = list(_lookup_many(args,False))
+    _unload_scoped(args,env,
+        ['/'.join((module.name,loaded[module.name]))
+         for module,_ in modules if module.name in loaded],
+        [module.name for module,_ in modules])
+    for module,version in modules:
         try:
-            Module.unload(db.lookup(name),env,strict=True)
+            Module.unload(module,env,strict=True)
         except ModuleError as e:
             e.warn()
+    env.cache_localization()
     env.dump()
 
 
@@ -107,15 +322,20 @@ def show(args):
     aliases: display
     """
 
+    from module import ModuleError, Module, ModuleEnv, loaded_modules
+
     env = ModuleEnv()
-    db = ModuleDb()
-    for moduleid in args.module:
-        name,version = splitid(moduleid)
+    args.module = _moduledb(args).qualify(args.module, loaded_modules())
+    for module,version in _lookup_many(args):
         try:
-            Module.show(db.lookup(name),env,version)
+            if args.json:
+                _print_json([module.describe(version)])
+            else:
+                Module.show(module,env,version)
         except ModuleError as e:
             e.warn()
-    env.dump(sys.stderr)
+    if not args.json:
+        env.dump(sys.stderr)
 
 
 def help(args):
@@ -124,28 +344,294 @@ def help(args):
     aliases: whatis
     """
 
+    from module import ModuleError, loaded_modules
+
     # Doesn't use ModuleEnv or Module
-    name,version = splitid(args.module)
+    moduleid, = _moduledb(args).qualify([args.module], loaded_modules())
+    name,version = splitid(moduleid)
     try:
-        ModuleDb().lookup(name).help(version)
+        module = _moduledb(args).lookup(name,version)
+        if args.json:
+            _print_json([module.describe(version)])
+        else:
+            module.help(version)
     except ModuleError as e:
         e.warn()
 
 
+def _collection(name):
+    """
+    Return the path of the user's saved collection of modules with the name.
+    """
+
+    from module import ModuleError
+
+    if not name or os.path.basename(name) != name or name.startswith('.'):
+        raise ModuleError("invalid collection name '%s'" % name)
+    return os.path.join(os.path.expanduser(MODULECOLLECTIONS), name)
+
+
+def save(args):
+    """
+    Save the loaded modules as a named collection, to restore later.
+    """
+
+    import json
+    from module import ModuleError, compile_delta
+
+    moduleids = [m for m in os.getenv(LOADEDMODULES, '').split(':') if m]
+    if not moduleids:
+        info("no modules are loaded")
+        return
+
+    # Compile the changes for restoring the collection in a new shell.
+    moduledb = _moduledb(args)
+    args.module = moduleids
+    messages, deltas = compile_delta(list(_lookup_many(args)))
+    collection = {
+        'generation': moduledb.get_meta('generation'),
+        'moduleids': moduleids,
+        'messages': messages,
+        'deltas': [(variable,) + delta
+                   for variable,delta in sorted(deltas.iteritems())]}
+
+    try:
+        path = _collection(args.name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmpfile = '%s.%d' % (path, os.getpid())
+        f = open(tmpfile, 'w')
+        try:
+            json.dump(collection, f)
+        finally:
+            f.close()
+        os.rename(tmpfile, path)
+    except ModuleError as e:
+        e.warn()
+        return
+    except (IOError, OSError) as e:
+        ModuleError("can't save collection '%s': %s" % (
+                    args.name, e.strerror)).warn()
+        return
+    info("saved collection '%s': %s" % (args.name, ' '.join(moduleids)))
+
+
+def _read_collection(name):
+    """
+    Return the user's saved collection of modules with the name.
+    """
+
+    import json
+    from module import ModuleError
+
+    try:
+        f = open(_collection(name))
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        raise ModuleError("no saved collection '%s'" % name)
+
+
+def restore(args):
+    """
+    Load the modules of a saved collection.
+    """
+
+    from module import ModuleError, ModuleEnv, loaded_modules
+
+    try:
+        collection = _read_collection(args.name)
+    except ModuleError as e:
+        e.warn()
+        return
+
+    env = ModuleEnv()
+    moduledb = _moduledb(args)
+    moduleids = [str(m) for m in collection['moduleids']]
+    loaded = loaded_modules()
+
+    # The compiled changes are only valid for the database they were
+    # compiled from, in a shell where none of the modules, or modules that
+    # conflict with them, are loaded.
+    if collection['generation'] == moduledb.get_meta('generation') and \
+       not any(splitid(m)[0] in loaded for m in moduleids) and \
+       not moduledb.conflicts(moduleids):
+        print >>sys.stderr, collection['messages']
+        _apply(env,[[str(x) if x is not None else None for x in delta]
+                    for delta in collection['deltas']])
+    else:
+        if collection['generation'] != moduledb.get_meta('generation'):
+            info("collection '%s' was saved with an older database: "
+                 "run 'module save %s' to update it" % (args.name, args.name))
+        args.module = moduleids
+        _load(args,env)
+    env.cache_localization()
+    env.dump()
+
+
+def _read_profile(profile):
+    """
+    Return a list of the module ids loaded by each `module load` and `module
+    restore` line of a profile, or None if it has any other commands and
+    must be sourced by the shell instead. A profile that can't be read loads
+    nothing.
+    """
+
+    from module import ModuleError
+
+    try:
+        f = open(profile)
+        try:
+            lines = f.read().splitlines()
+        finally:
+            f.close()
+    except IOError:
+        return []
+
+    moduleids = []
+    for line in lines:
+        words = line.partition('#')[0].split()
+        if not words:
+            continue
+        if len(words) < 2 or words[0] != 'module':
+            return None
+        if words[1] in ('load', 'add') and len(words) > 2:
+            moduleids.append(words[2:])
+        elif words[1] == 'restore' and len(words) <= 3:
+            name = words[2] if len(words) == 3 else 'default'
+            try:
+                moduleids.append(
+                    map(str, _read_collection(name)['moduleids']))
+            except ModuleError as e:
+                e.warn()
+        else:
+            return None
+    return moduleids
+
+
+def init(args):
+    """
+    Load the modules in the site and user profiles at login, in one process.
+    """
+
+    from module import ModuleEnv
+
+    # Profiles before and including the first one that isn't declarative
+    # are loaded here, the rest are sourced by the shell afterwards.
+    moduleids = []
+    sourced = []
+    for profile in MODULEPROFILES:
+        profile = os.path.expanduser(profile)
+        loads = None if sourced else _read_profile(profile)
+        if loads is None:
+            sourced.append(profile)
+        else:
+            moduleids += loads
+
+    # Each line is loaded on top of the modules loaded by the lines before
+    # it, as when the profiles are sourced, so that a line that fails only
+    # skips its own modules.
+    env = ModuleEnv()
+    loaded = os.environ.get(LOADEDMODULES)
+    try:
+        for line in moduleids:
+            args.module = line
+            _load(args,env)
+            os.environ[LOADEDMODULES] = env.get(LOADEDMODULES) or ''
+    finally:
+        if loaded is None:
+            os.environ.pop(LOADEDMODULES,None)
+        else:
+            os.environ[LOADEDMODULES] = loaded
+    env.cache_localization()
+    env.dump()
+    source = 'source' if MODULESHELL == 'csh' else '.'
+    for profile in sourced:
+        print '%s "%s";' % (source, profile)
+
+
 def list_bin(args):
     """ 
     List the programs provided by the module.
     """
 
-    db = ModuleDb()
-    for moduleid in args.module:
-        name,version = splitid(moduleid)
+    from module import ModuleError, Module, loaded_modules
+    from moduleutil import localize
+
+    args.module = _moduledb(args).qualify(args.module, loaded_modules())
+    modules = list(_lookup_many(args))
+
+    # Answer from the database's index of bin directories in one query.
+    directories = set()
+    for module,version in modules:
+        for path in module.paths.get(version or module.default_version, []):
+            directories.add(localize(path))
+    index = _moduledb(args).lookup_files(directories)
+
+    for module,version in modules:
         try:
-            Module.list_bin(db.lookup(name),version)
+            if args.json:
+                moduleid = '/'.join([module.name,
+                                     version or module.default_version])
+                _print_json({'module': moduleid,
+                             'directory': directory,
+                             'programs': programs}
+                            for directory,programs in
+                            module.bin_directories(version,index))
+            else:
+                Module.list_bin(module,version,index)
         except ModuleError as e:
             e.warn()
 
 
+def provides(args):
+    """
+    List the modules that provide a file, in their bin, lib or include
+    directories.
+    """
+
+    from module import ModuleError
+
+    moduledb = _moduledb(args)
+    for pattern in args.file:
+        try:
+            matches = moduledb.provides(pattern)
+        except ModuleError as e:
+            e.warn()
+            return
+        if not matches:
+            info("no module provides '%s'" % pattern)
+        if args.json:
+            _print_json({'file': pattern,
+                         'name': name,
+                         'module': moduleid,
+                         'directory': directory}
+                        for name,moduleid,directory in matches)
+            continue
+        for name,moduleid,directory in matches:
+            print >>sys.stderr, "%s: %s (%s)" % (name, moduleid, directory)
+
+
+def complete(args):
+    """
+    Print the module ids that start with a prefix, for tab completion.
+    """
+
+    matches = None
+    if trusted(MODULELOCALCOMPLETION):
+        matches = prefix_matches(args.prefix, MODULELOCALCOMPLETION)
+    if matches is None:
+        matches = prefix_matches(args.prefix, MODULECOMPLETION)
+    if matches is None:
+        # Fall back to the database if there is no completion file.
+        matches = [m for m in sorted(_moduledb(args).avail(splitid(args.prefix)[0]))
+                   if m.startswith(args.prefix)]
+    for moduleid in matches:
+        print moduleid
+
+
 def alias_subcommand(argv):
     """
     Substitute aliases for each command.
@@ -159,41 +645,203 @@ def alias_subcommand(argv):
         elif argv[i] == 'whatis': argv[i] = 'help'
 
 
-def main():
-
-    parser = argparse.ArgumentParser(prog='modulecmd')
-
-    subparsers = parser.add_subparsers(title='subcommands')
-
-    avail_parser = subparsers.add_parser('avail', help=avail.__doc__)
-    avail_parser.add_argument('module',nargs='*')
-    avail_parser.set_defaults(func=avail)
-
-    load_parser = subparsers.add_parser('load', help=load.__doc__)
-    load_parser.add_argument('module',nargs='+')
-    load_parser.set_defaults(func=load)
-
-    unload_parser = subparsers.add_parser('unload', help=unload.__doc__)
-    unload_parser.add_argument('module',nargs='+')
-    unload_parser.set_defaults(func=unload)
+# The subcommands, with the destination, nargs and default of their one
+# positional argument, and the defaults of their options.
+SUBCOMMANDS = (
+    ('avail', avail, 'module', '*', None,
+        {'search': False, 'terse': False, 'limit': None, 'offset': 0,
+         'json': False}),
+    ('load', load, 'module', '+', None, {}),
+    ('unload', unload, 'module', '+', None, {}),
+    ('list', list_loaded, None, None, None, {'json': False}),
+    ('show', show, 'module', '+', None, {'json': False}),
+    ('help', help, 'module', None, None, {'json': False}),
+    ('bin', list_bin, 'module', '+', None, {'json': False}),
+    ('provides', provides, 'file', '+', None, {'json': False}),
+    ('save', save, 'name', '?', 'default', {}),
+    ('restore', restore, 'name', '?', 'default', {}),
+    ('init', init, None, None, None, {}),
+    ('complete', complete, 'prefix', '?', '', {}),
+)
+
+
+class Args:
+    """
+    The parsed arguments of a subcommand.
+    """
 
-    list_parser = subparsers.add_parser('list', help=list_loaded.__doc__)
-    list_parser.set_defaults(func=list_loaded)
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
 
-    show_parser = subparsers.add_parser('show', help=show.__doc__)
-    show_parser.add_argument('module',nargs='+')
-    show_parser.set_defaults(func=show)
 
-    help_parser = subparsers.add_parser('help', help=help.__doc__)
-    help_parser.add_argument('module')
-    help_parser.set_defaults(func=help)
+def parse_args(argv):
+    """
+    Parse the arguments of a subcommand that are only positional, without
+    the cost of importing argparse, or return None if argparse is needed to
+    parse the options or report a usage error.
+    """
 
-    bin_parser = subparsers.add_parser('bin', help=list_bin.__doc__)
-    bin_parser.add_argument('module',nargs='+')
-    bin_parser.set_defaults(func=list_bin)
+    subcommands = dict((s[0], s[1:]) for s in SUBCOMMANDS)
+    if len(argv) < 2 or argv[1] not in subcommands:
+        return None
+    words = argv[2:]
+    if any(word.startswith('-') for word in words):
+        return None
+
+    func, dest, nargs, default, options = subcommands[argv[1]]
+    args = Args(func=func, **options)
+    if dest is None:
+        if words:
+            return None
+    elif nargs is None:
+        if len(words) != 1:
+            return None
+        setattr(args, dest, words[0])
+    elif nargs == '?':
+        if len(words) > 1:
+            return None
+        setattr(args, dest, words[0] if words else default)
+    else:
+        if nargs == '+' and not words:
+            return None
+        setattr(args, dest, words)
+    return args
+
+
+def _instrument_module(profile, module):
+    """
+    Wrap the phases of a command in the module module, and count the
+    database queries and path operations.
+    """
 
-    alias_subcommand(sys.argv)
-    args = parser.parse_args()
+    import moduleutil
+
+    connect = module.ModuleDb.connect
+    def connect_counted(self, *args, **kwargs):
+        connect(self, *args, **kwargs)
+        self.conn = profile.proxy(self.conn, ('execute', 'executemany'),
+                                  'query')
+    module.ModuleDb.connect = connect_counted
+
+    phases = (
+        (module.ModuleDb, ('connect',), 'connect'),
+        (module.ModuleDb, ('lookup', 'lookup_many', 'lookup_bundle',
+                           'lookup_files', 'get_meta'), 'lookup'),
+        (module.ModuleDb, ('qualify', 'dependencies'), 'resolve'),
+        (module, ('resolve',), 'resolve'),
+        (module.ModuleDb, ('avail', 'avail_category', 'search', 'suggest',
+                           'provides'), 'avail'),
+        (moduleutil, ('_load_localized',), 'localize'),
+        (module.Module, ('load', 'unload', 'show', 'list_bin'), 'env'),
+        (module.ModuleEnv, ('apply',), 'env'),
+        (module.ModuleEnv, ('dump',), 'dump'))
+    for obj, attrs, phase in phases:
+        for attr in attrs:
+            profile.time(obj, attr, phase)
+    for attr in ('prepend', 'append', 'remove'):
+        profile.count(module.PathList, attr, 'path')
+
+
+def _start_profile():
+    """
+    Return the profile of this command if MODULE_PROFILE is set, after
+    instrumenting the imports, filesystem calls and, once it is imported,
+    the database module.
+    """
+    global _profile
+
+    # Read for each command, since the module server runs each one in the
+    # client's environment.
+    output = os.environ.get(MODULEPROFILE)
+    if not output or output == '0':
+        return None
+    if _profile is not None:
+        _profile.reset()
+        _profile.output = output
+        return _profile
+
+    import __builtin__
+
+    _profile = profile = Profile(output)
+    for obj, attr, counter in ((os, 'stat', 'stat'), (os, 'lstat', 'stat'),
+                               (os, 'listdir', 'listdir'),
+                               (os, 'open', 'open'),
+                               (__builtin__, 'open', 'open')):
+        profile.count(obj, attr, counter)
+
+    # The database module is instrumented once its outermost import is
+    # complete.
+    instrumented = []
+    importing = []
+    builtin_import = __builtin__.__import__
+    def instrument_import(name, *args, **kwargs):
+        importing.append(name)
+        try:
+            imported = builtin_import(name, *args, **kwargs)
+        finally:
+            importing.pop()
+        if not importing and not instrumented and 'module' in sys.modules:
+            instrumented.append(True)
+            _instrument_module(profile, sys.modules['module'])
+        return imported
+    __builtin__.__import__ = instrument_import
+    profile.time(__builtin__, '__import__', 'import')
+
+    if 'module' in sys.modules:
+        instrumented.append(True)
+        _instrument_module(profile, sys.modules['module'])
+    return profile
+
+
+def main(argv=None,moduledb=None):
+
+    if argv is None:
+        argv = sys.argv
+
+    profile = _start_profile()
+    if profile and moduledb is not None:
+        # The startup of the module server isn't part of the command.
+        profile.startup = None
+    try:
+        _main(argv,moduledb)
+    finally:
+        flush_usage()
+        if profile:
+            profile.report(' '.join(argv[1:]))
+
+
+def _main(argv,moduledb):
+
+    alias_subcommand(argv)
+    args = parse_args(argv)
+    if args is None:
+        import argparse
+
+        parser = argparse.ArgumentParser(prog='modulecmd')
+
+        subparsers = parser.add_subparsers(title='subcommands')
+
+        for name, func, dest, nargs, default, options in SUBCOMMANDS:
+            subparser = subparsers.add_parser(name, help=func.__doc__)
+            if 'json' in options:
+                subparser.add_argument('--json',action='store_true',
+                    help="print JSON records to stdout, one per line")
+            if func is avail:
+                subparser.add_argument('-s','--search',action='store_true',
+                    help="list modules whose name, version, category or "
+                         "description contain all of the search terms")
+                subparser.add_argument('-t','--terse',action='store_true',
+                    help="list one module id per line, without titles")
+                subparser.add_argument('--limit',type=int,
+                    help="list at most this many modules for each argument")
+                subparser.add_argument('--offset',type=int,default=0,
+                    help="skip this many modules for each argument")
+            if dest is not None:
+                subparser.add_argument(dest,nargs=nargs,default=default)
+            subparser.set_defaults(func=func)
+
+        args = parser.parse_args(argv[1:])
+    args.moduledb = moduledb
     args.func(args)
 
 
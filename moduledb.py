@@ -23,17 +23,33 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 
+import os
 import sys
+import time
 import argparse
 
 from module import ModuleError, ModuleDb
-from modulecfg import MODULEPATH
+from modulecfg import MODULEPATH, MODULEDB, MODULELOCALDB, MODULEUSAGE
+from modulecfg import usagedir
+from moduleutil import info
 
 def _rebuild(args):
     # Rebuild the module database from modulefiles in the path
 
     moduledb = ModuleDb()
-    moduledb.rebuild(args.modulepath)
+    moduledb.rebuild(args.modulepath,args.jobs)
+
+
+def _sync(args):
+    # Update the database with the modulefiles that changed in the path
+
+    try:
+        counts = ModuleDb().sync(args.modulepath,args.jobs)
+    except ModuleError as e:
+        e.warn()
+    else:
+        info("synced '%s': %d added, %d changed, %d deleted" % (
+             (args.modulepath,) + counts))
 
 
 def _insert(args):
@@ -44,20 +60,112 @@ def _insert(args):
         moduledb.insert(modulefile,args.force)
 
 
+def _publish(args):
+    # Publish a snapshot of the database for nodes to pull
+
+    try:
+        generation = ModuleDb().snapshot()
+    except ModuleError as e:
+        e.warn()
+    else:
+        info("published generation %s of '%s'" % (generation, MODULEDB))
+
+
+def _pull(args):
+    # Copy the published snapshot to this node, if it changed
+
+    try:
+        generation = ModuleDb(readonly=True).pull()
+    except ModuleError as e:
+        e.warn()
+    else:
+        if generation is not None:
+            info("pulled generation %s to '%s'" % (generation, MODULELOCALDB))
+
+
+def _usage(args):
+    # Merge the usage spools into the usage statistics, and print them
+
+    spools = args.spool
+    if not spools and usagedir and os.path.isdir(usagedir):
+        spools = [os.path.join(usagedir, name)
+                  for name in sorted(os.listdir(usagedir))
+                  if name.startswith('usage.') and name[6:].isdigit()]
+
+    moduledb = ModuleDb()
+    try:
+        if spools:
+            loads = moduledb.merge_usage(spools)
+            info("merged %d loads into '%s'" % (loads, MODULEUSAGE))
+        if args.merge:
+            return
+        rows = moduledb.usage()
+    except ModuleError as e:
+        e.warn()
+        return
+
+    print "%8s %6s %6s %12s  %-16s  %s" % (
+          'loads', 'users', 'hosts', 'latency ms', 'last load', 'module')
+    for moduleid,loads,users,hosts,latency,last in rows:
+        if args.unused and loads:
+            continue
+        print "%8d %6d %6d %12s  %-16s  %s" % (
+              loads, users, hosts,
+              '%.2f' % (1000 * latency) if latency is not None else '-',
+              time.strftime('%Y-%m-%d %H:%M', time.localtime(last))
+              if last is not None else '-',
+              moduleid)
+
+
+def _migrate(args):
+    # Convert a database of pickled modules to the current schema
+
+    try:
+        ModuleDb().migrate()
+    except ModuleError as e:
+        e.warn()
+
+
 def main():
 
     parser = argparse.ArgumentParser(prog='moduledb')
     subparsers = parser.add_subparsers(title='subcommands')
 
     rebuild_parser = subparsers.add_parser('rebuild')
+    rebuild_parser.add_argument('-j','--jobs',type=int,
+        help="number of processes for parsing modulefiles (default: one per CPU)")
     rebuild_parser.add_argument('modulepath',nargs='?',default=MODULEPATH)
     rebuild_parser.set_defaults(func=_rebuild)
 
+    sync_parser = subparsers.add_parser('sync')
+    sync_parser.add_argument('-j','--jobs',type=int,
+        help="number of processes for parsing modulefiles (default: one per CPU)")
+    sync_parser.add_argument('modulepath',nargs='?',default=MODULEPATH)
+    sync_parser.set_defaults(func=_sync)
+
     insert_parser = subparsers.add_parser('insert')
     insert_parser.add_argument('-f','--force',action='store_true');
     insert_parser.add_argument('modulefile',nargs='+')
     insert_parser.set_defaults(func=_insert)
 
+    publish_parser = subparsers.add_parser('publish')
+    publish_parser.set_defaults(func=_publish)
+
+    pull_parser = subparsers.add_parser('pull')
+    pull_parser.set_defaults(func=_pull)
+
+    usage_parser = subparsers.add_parser('usage')
+    usage_parser.add_argument('-m','--merge',action='store_true',
+        help="only merge the spools, without printing the statistics")
+    usage_parser.add_argument('-u','--unused',action='store_true',
+        help="only print the modules that were never loaded")
+    usage_parser.add_argument('spool',nargs='*',
+        help="usage spool files to merge (default: the spools in usagedir)")
+    usage_parser.set_defaults(func=_usage)
+
+    migrate_parser = subparsers.add_parser('migrate')
+    migrate_parser.set_defaults(func=_migrate)
+
     args = parser.parse_args()
     args.func(args)
 
@@ -0,0 +1,204 @@
+#
+# PyModules - Software Environments for Research Computing Clusters
+#
+# Copyright 2012-2013, Brown University, Providence, RI. All Rights Reserved.
+#
+# This file is part of PyModules.
+#
+# Permission to use, copy, modify, and distribute this software and its
+# documentation for any purpose other than its incorporation into a
+# commercial product is hereby granted without fee, provided that the
+# above copyright notice appear in all copies and that both that
+# copyright notice and this permission notice appear in supporting
+# documentation, and that the name of Brown University not be used in
+# advertising or publicity pertaining to distribution of the software
+# without specific, written prior permission.
+#
+# BROWN UNIVERSITY DISCLAIMS ALL WARRANTIES WITH REGARD TO THIS SOFTWARE,
+# INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR ANY
+# PARTICULAR PURPOSE.  IN NO EVENT SHALL BROWN UNIVERSITY BE LIABLE FOR
+# ANY SPECIAL, INDIRECT OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+
+import argparse
+import json
+import os
+import signal
+import socket
+import SocketServer
+import struct
+import sys
+import traceback
+from StringIO import StringIO
+
+import modulecmd
+from module import ModuleDb
+from modulecfg import MODULEPATH, MODULESHELL, MODULESOCKET
+
+# Python 2 doesn't define the socket option for the peer's credentials.
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+# Subcommands that read or write files in the user's home directory, which
+# the server only runs for its own user.
+PRIVATE = ('save', 'restore', 'init')
+
+
+class CachedModuleDb(ModuleDb):
+    """ A database that keeps modules in memory between requests """
+
+    def __init__(self):
+        self.stamp = None
+        self.cache = {}
+        ModuleDb.__init__(self,readonly=True)
+
+
+    def refresh(self):
+        """ Reconnects and empties the cache if the database was replaced """
+
+        try:
+            st = os.stat(self.dbfile())
+            stamp = (st.st_ino, st.st_mtime, st.st_size)
+        except OSError:
+            stamp = None
+        if stamp != self.stamp:
+            self.connect()
+            self.cache.clear()
+            self.stamp = stamp
+
+
+    def lookup_many(self,moduleids):
+        """ Return a dictionary of the named modules from the cache """
+
+        # Read all versions, so the cached modules serve any request.
+        missing = [(name,None) for name,_ in moduleids
+                   if name not in self.cache]
+        if missing:
+            self.cache.update(ModuleDb.lookup_many(self,missing))
+        return dict((name,self.cache[name]) for name,_ in moduleids
+                    if name in self.cache)
+
+
+class ModuleRequestHandler(SocketServer.StreamRequestHandler):
+    """ Answers a single modulecmd request read from the socket """
+
+    # Requests are served one at a time, so don't let a client that never
+    # finishes sending its request hold up everyone else's commands.
+    timeout = 1
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.read())
+        except (ValueError, socket.timeout):
+            return
+        try:
+            creds = self.request.getsockopt(
+                socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+            uid = struct.unpack('3i', creds)[1]
+        except socket.error:
+            uid = None
+        self.wfile.write(json.dumps(self.server.run(request,uid)))
+
+
+class ModuleServer(SocketServer.UnixStreamServer):
+    """
+    Serves modulecmd requests over a Unix socket, keeping the database
+    connection, modules and localization warm between requests.
+
+    Requests are handled one at a time, since each one temporarily takes over
+    the server's environment and standard streams.
+    """
+
+    def __init__(self,path,mode):
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self,path,ModuleRequestHandler)
+        os.chmod(path,mode)
+        self.moduledb = CachedModuleDb()
+
+
+    def run(self,request,uid=None):
+        """
+        Runs modulecmd with the client's arguments and environment, for the
+        client running as uid.
+        """
+
+        # Output is formatted for the shell the server was started with, and
+        # comes from the database in the server's MODULEPATH.
+        if request.get('shell') != MODULESHELL or \
+           request['environ'].get('MODULEPATH') != MODULEPATH:
+            return {'status': None}
+
+        # The client's HOME, or a profile file in MODULE_PROFILE, would let
+        # it read and write files anywhere as the server's user.
+        if uid != os.getuid() and (
+           any(arg in PRIVATE for arg in request['argv']) or
+           request['environ'].get('MODULE_PROFILE', '0') not in
+               ('', '0', '1', 'stderr')):
+            return {'status': None}
+
+        environ = dict(os.environ)
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        status = 0
+        try:
+            os.environ.clear()
+            for key, val in request['environ'].iteritems():
+                os.environ[key.encode('utf-8')] = val.encode('utf-8')
+            self.moduledb.refresh()
+            argv = [arg.encode('utf-8') for arg in request['argv']]
+            modulecmd.main(['modulecmd'] + argv, self.moduledb)
+        except SystemExit as e:
+            status = e.code or 0
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            reply = {
+                'status': status,
+                'stdout': sys.stdout.getvalue(),
+                'stderr': sys.stderr.getvalue()}
+            sys.stdout, sys.stderr = stdout, stderr
+            os.environ.clear()
+            os.environ.update(environ)
+        return reply
+
+
+def main():
+
+    parser = argparse.ArgumentParser(prog='moduleserver')
+    parser.add_argument('-s','--socket',default=MODULESOCKET,
+        help="path of the Unix socket (default: $MODULESOCKET)")
+    parser.add_argument('-m','--mode',default='0600',
+        help="permissions of the socket: use 0666 to serve all users "
+             "on the node (default: 0600)")
+    args = parser.parse_args()
+
+    if not args.socket:
+        parser.error("no socket specified and MODULESOCKET is not set")
+
+    server = ModuleServer(args.socket,int(args.mode,8))
+
+    # Finish the current request before stopping on SIGTERM.
+    server.timeout = 1
+    server.stopping = False
+    def stop(signum, frame):
+        server.stopping = True
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        while not server.stopping:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:ts=4:shiftwidth=4:expandtab:
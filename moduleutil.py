@@ -23,50 +23,320 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 
+import bisect
+import itertools
 import os
+import re
 import sys
-import subprocess
+import time
+
+from modulecfg import MODULEDB, MODULELOCALIZATION, localdir, usagedir
 
 
 _localized = None
+_localized_env = False
+_usage = []
+
+_vendors = ('intel', 'amd', '.')
+_simds = ('avx', 'sse4.2', 'sse4a', 'sse3', '.')
 
 
 def splitid(moduleid):
-    """ Return the module and name from the moduleid """
+    """
+    Return the module and name from the moduleid. The name of a module in the
+    scope of another module version is prefixed by that module id, as in
+    `gcc/4.8/hdf5/1.8.9`, so a moduleid with an odd number of parts has no
+    version.
+    """
     
-    moduleid = moduleid.split('/',1)
-    if len(moduleid) == 1:
-        moduleid.append('')
-    return moduleid[0],moduleid[1]
+    moduleid = moduleid.split('/')
+    if len(moduleid) % 2:
+        return '/'.join(moduleid),''
+    return '/'.join(moduleid[:-1]),moduleid[-1]
+
+
+def version_key(version):
+    """
+    Return a string that sorts versions in natural order, so that `1.9`
+    comes before `1.10`: each run of digits is prefixed by its length, and
+    compared as a number.
+    """
+
+    def number(match):
+        digits = match.group().lstrip('0') or '0'
+        return '%02d%s' % (len(digits), digits)
+
+    return re.sub(r'\d+', number, version)
+
+
+def terminal_width():
+    """
+    Return the width of the terminal, from the `COLUMNS` environment variable
+    or else the terminal on stderr, where lists are printed, or 80 if neither
+    is set.
+    """
+
+    try:
+        return int(os.environ['COLUMNS'])
+    except (KeyError, ValueError):
+        pass
+    try:
+        import fcntl, struct, termios
+        width = struct.unpack('hh', fcntl.ioctl(
+                    sys.stderr.fileno(), termios.TIOCGWINSZ, '\0' * 4))[1]
+    except (IOError, AttributeError, ValueError):
+        width = 0
+    return width or 80
 
 
-def print_centered(string,term_width=80,pad_char='~'):
+def print_centered(string,term_width=None,pad_char='~'):
     """ Print a string centered in the terminal """
 
+    if term_width is None:
+        term_width = terminal_width()
     print >>sys.stderr, (' '+string+' ').center(term_width,pad_char)
 
 
-def print_columns(moduleids,term_width=80):
-    """ Print a list of strings in columns """
+def print_columns(moduleids,term_width=None,block=1000):
+    """
+    Print strings in columns, from a list or iterator. Long lists are laid
+    out and printed in blocks of up to `block` strings as they are read.
+    Returns the number of strings printed.
+    """
+
+    if term_width is None:
+        term_width = terminal_width()
+
+    moduleids = iter(moduleids)
+    count = 0
+    while True:
+        moduleids_block = list(itertools.islice(moduleids, block))
+        if not moduleids_block:
+            return count
+        count += len(moduleids_block)
+
+        # Calculate the number of columns based on the longest string
+        column_width = max(len(moduleid) for moduleid in moduleids_block)+2
+        num_columns = max(1, term_width/column_width)
+        column_length = (len(moduleids_block)+num_columns-1)/num_columns
+
+        # Print in columns, padding each moduleid with spaces
+        for i in range(column_length):
+            print >>sys.stderr, ''.join(moduleid.ljust(column_width)
+                for moduleid in moduleids_block[i::column_length])
+
+
+def prefix_matches(prefix,completionfile):
+    """
+    Return the lines of the sorted completion file that start with prefix,
+    or None if the file can't be read.
+    """
+
+    try:
+        f = open(completionfile)
+        try:
+            moduleids = f.read().splitlines()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+    matches = []
+    for moduleid in moduleids[bisect.bisect_left(moduleids, prefix):]:
+        if not moduleid.startswith(prefix):
+            break
+        matches.append(moduleid)
+    return matches
+
+
+def _parse_cpuinfo():
+    """ Return the localization table read from `/proc/cpuinfo`. """
 
-    if not moduleids: return;
+    localized = { 'vendor': '.', 'simd': '.', 'model': '.' }
+    if os.path.exists('/proc/cpuinfo'):
+        try:
+            model = []
+            for line in open('/proc/cpuinfo'):
+                line = line.rstrip().split()
+                if line[0] == 'vendor_id':
+                    if line[2] == 'GenuineIntel':
+                        localized['vendor'] = 'intel'
+                    elif line[2] == 'AuthenticAMD':
+                        localized['vendor'] = 'amd'
+                    model.append(localized['vendor'])
+                elif line[0] == 'cpu' and line[1] == 'family':
+                    model.append(line[-1])
+                elif line[0] == 'model' and line[1] == ':':
+                    model.append(line[-1])
+                elif line[0] == 'flags':
+                    flags = set(line[2:])
+                    if 'avx' in flags:
+                        localized['simd'] = 'avx'
+                    elif 'sse4_2' in flags:
+                        localized['simd'] = 'sse4.2'
+                    elif 'sse4a' in flags:
+                        localized['simd'] = 'sse4a'
+                    elif 'sse3' in flags:
+                        localized['simd'] = 'sse3'
+                    # No more lines need to be read.
+                    break
 
-    # Calculate the number of columns based on the longest string
-    column_width = max(len(moduleid) for moduleid in moduleids)+2
-    num_columns = term_width/column_width
-    column_length = (len(moduleids)+num_columns-1)/num_columns
+            # Only set model if all three fields are found.
+            if len(model) == 3 and model[0] != '.':
+                localized['model'] = '-'.join(model)
 
-    # Pad the moduleid with spaces
-    moduleids = [moduleid.ljust(column_width) for moduleid in moduleids]
+        except:
+            print >>sys.stderr, \
+                "module: warning: couldn't parse /proc/cpuinfo"
 
-    # Print in columns
-    for i in range(column_length):
-        line = ''
-        for j in range(num_columns):
-            k = j*column_length+i
-            if k < len(moduleids):
-                line += moduleids[k]
-        print >>sys.stderr, line
+    return localized
+
+
+def _unpack_localized(values):
+    """
+    Return the localization table from a list of vendor, simd and model
+    values, or None if any of them is invalid.
+    """
+
+    if len(values) != 3:
+        return None
+    vendor, simd, model = values
+    if vendor not in _vendors:
+        return None
+    if simd not in _simds:
+        return None
+    if model != '.' and not all(s.isalnum() for s in model.split('-')):
+        return None
+    return { 'vendor': vendor, 'simd': simd, 'model': model }
+
+
+def _boot_id():
+    """ Return the boot ID of the node, or None if it isn't available. """
+
+    try:
+        f = open('/proc/sys/kernel/random/boot_id')
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+
+def _load_localized():
+    """
+    Return the localization table, from the first of these that is valid:
+
+    1. The `MODULELOCALIZATION` environment variable, if it was set on this
+       node (this needs no file I/O).
+    2. The cache file for this user in `localdir`, if it was written since
+       the node booted.
+    3. The `/proc/cpuinfo` interface, which is then written to the cache.
+    """
+    global _localized_env
+
+    host = os.uname()[1]
+    values = os.getenv(MODULELOCALIZATION, '').split(':')
+    if values[0] == host:
+        localized = _unpack_localized(values[1:])
+        if localized:
+            _localized_env = True
+            return localized
+
+    cachefile = os.path.join(localdir, 'localization.%d' % os.getuid())
+    boot_id = _boot_id()
+    try:
+        f = open(cachefile)
+        try:
+            # localdir is shared, so only trust a file this user wrote.
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                raise IOError
+            values = f.read().split()
+        finally:
+            f.close()
+        if boot_id and values[0] == boot_id:
+            localized = _unpack_localized(values[1:])
+            if localized:
+                return localized
+    except (IOError, OSError, IndexError):
+        pass
+
+    localized = _parse_cpuinfo()
+    if boot_id:
+        try:
+            make_localdir()
+            tmpfile = '%s.%d' % (cachefile, os.getpid())
+            fd = _create(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            try:
+                os.write(fd, '%s %s %s %s\n' % (boot_id, localized['vendor'],
+                             localized['simd'], localized['model']))
+            finally:
+                os.close(fd)
+            os.rename(tmpfile, cachefile)
+        except OSError:
+            pass
+    return localized
+
+
+def _create(path,flags):
+    """
+    Open a file for this user in a directory that all users share, without
+    following a symlink that another user put in its place, and return the
+    file descriptor. Raises OSError if the file belongs to another user.
+    """
+
+    fd = os.open(path, flags | os.O_NOFOLLOW, 0644)
+    if os.fstat(fd).st_uid != os.getuid():
+        os.close(fd)
+        raise OSError("'%s' belongs to another user" % path)
+    return fd
+
+
+def make_localdir(directory=localdir,mode=01777):
+    """
+    Create the `localdir` directory, or another node-local directory, which
+    all users share, if it doesn't exist yet.
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+        os.chmod(directory, mode)
+
+
+def trusted(path):
+    """
+    Return whether a node-local copy of a shared file can be trusted: the
+    file and its directory must be owned by root, this user or the owner of
+    the database, and not be writable by anyone else.
+    """
+
+    owners = [0, os.getuid()]
+    try:
+        for st in (os.stat(path), os.stat(os.path.dirname(path))):
+            if st.st_mode & 022:
+                return False
+            if st.st_uid not in owners:
+                # Only look at the shared database if it is needed.
+                if len(owners) == 2:
+                    owners.append(os.stat(MODULEDB).st_uid)
+                if st.st_uid not in owners:
+                    return False
+    except OSError:
+        return False
+    return True
+
+
+def localization():
+    """
+    Return the value to export in `MODULELOCALIZATION` so that later commands
+    in this shell can skip loading the localization table, or None if it is
+    already in the environment or wasn't needed by this command.
+    """
+
+    if not _localized or _localized_env:
+        return None
+    return ':'.join((os.uname()[1], _localized['vendor'],
+                     _localized['simd'], _localized['model']))
 
 
 def localize(path):
@@ -79,52 +349,66 @@ def localize(path):
     And the special value `%VENDOR$` with either `intel`, `amd`, or `.`.
 
     Note: only works on Linux, since values are read from `/proc/cpuinfo`.
+    The values are cached for the node in the environment and in `localdir`.
     """
     global _localized
 
     if not _localized:
-        _localized = { 'vendor': '.', 'simd': '.', 'model': '.' }
-        if os.path.exists('/proc/cpuinfo'):
-            try:
-                model = []
-                for line in open('/proc/cpuinfo'):
-                    line = line.rstrip().split()
-                    if line[0] == 'vendor_id':
-                        if line[2] == 'GenuineIntel':
-                            _localized['vendor'] = 'intel'
-                        elif line[2] == 'AuthenticAMD':
-                            _localized['vendor'] = 'amd'
-                        model.append(_localized['vendor'])
-                    elif line[0] == 'cpu' and line[1] == 'family':
-                        model.append(line[-1])
-                    elif line[0] == 'model' and line[1] == ':':
-                        model.append(line[-1])
-                    elif line[0] == 'flags':
-                        flags = set(line[2:])
-                        if 'avx' in flags:
-                            _localized['simd'] = 'avx'
-                        elif 'sse4_2' in flags:
-                            _localized['simd'] = 'sse4.2'
-                        elif 'sse4a' in flags:
-                            _localized['simd'] = 'sse4a'
-                        elif 'sse3' in flags:
-                            _localized['simd'] = 'sse3'
-                        # No more lines need to be read.
-                        break
-
-                # Only set model if all three fields are found.
-                if len(model) == 3 and model[0] != '.':
-                    _localized['model'] = '-'.join(model)
-
-            except:
-                print >>sys.stderr, \
-                    "module: warning: couldn't parse /proc/cpuinfo"
+        _localized = _load_localized()
 
     return path.replace('%VENDOR%', _localized['vendor']) \
                .replace('%SIMD%', _localized['simd']) \
                .replace('%MODEL%', _localized['model'])
 
 
+def localizations(path):
+    """
+    Return every localization of `path` over the possible `%VENDOR%` and
+    `%SIMD%` values, or an empty list if it contains `%MODEL%`, which
+    can't be enumerated.
+    """
+    if '%MODEL%' in path:
+        return []
+    return list(set(path.replace('%VENDOR%', vendor).replace('%SIMD%', simd)
+                    for vendor in _vendors for simd in _simds))
+
+
+def record_usage(moduleid, latency):
+    """
+    Record that the module was loaded, in the time latency, to be written
+    to the usage spool by flush_usage() at the end of the command.
+    """
+
+    if usagedir:
+        _usage.append((time.time(), moduleid, latency))
+
+
+def flush_usage():
+    """
+    Append the recorded usage to this user's spool file in `usagedir`, in a
+    single write. Usage that can't be written is dropped.
+    """
+
+    if not _usage:
+        return
+    user = os.getenv('USER') or os.getuid()
+    host = os.uname()[1]
+    records = ''.join('%.3f\t%s\t%s\t%s\t%.6f\n' % (
+                      timestamp, user, host, moduleid, latency)
+                      for timestamp,moduleid,latency in _usage)
+    del _usage[:]
+    try:
+        make_localdir(usagedir)
+        fd = _create(os.path.join(usagedir, 'usage.%d' % os.getuid()),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, records)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
 def info(msg):
     """
     Print an informational message to stderr, prefixed with "module: ".
@@ -132,4 +416,161 @@ def info(msg):
     print >>sys.stderr, "module:", msg
 
 
+def _process_started():
+    """
+    Return the time this process was started, to the resolution of the
+    kernel clock, or None if it isn't available.
+    """
+
+    try:
+        f = open('/proc/self/stat')
+        try:
+            # The start time is the 22nd field, counting the command name
+            # in parentheses (which can contain spaces) as the 2nd.
+            ticks = float(f.read().rsplit(')', 1)[1].split()[19])
+        finally:
+            f.close()
+        f = open('/proc/uptime')
+        try:
+            uptime = float(f.read().split()[0])
+        finally:
+            f.close()
+    except (IOError, IndexError, ValueError):
+        return None
+    return time.time() - uptime + ticks / os.sysconf('SC_CLK_TCK')
+
+
+class Profile:
+    """
+    Records the wall time of the phases of a command, and counts of the
+    operations it makes, by wrapping the functions that implement them.
+    """
+
+    def __init__(self,output):
+        self.output = output
+        self.reset()
+        started = _process_started()
+        if started is not None:
+            self.startup = max(0.0, self.started - started)
+
+
+    def reset(self):
+        """ Starts recording a new command """
+
+        self.started = time.time()
+        self.startup = None
+        self.phases = {}
+        self.counts = {}
+        self.active = set()
+
+
+    def time(self,obj,attr,phase):
+        """
+        Wraps the function obj.attr to add its wall time and calls to the
+        phase. Calls made while the phase is already being timed, like
+        nested imports, are part of the outer call.
+        """
+
+        func = getattr(obj,attr)
+        def timed(*args,**kwargs):
+            if phase in self.active:
+                return func(*args,**kwargs)
+            self.active.add(phase)
+            start = time.time()
+            try:
+                return func(*args,**kwargs)
+            finally:
+                self.active.discard(phase)
+                seconds,calls = self.phases.get(phase,(0.0,0))
+                self.phases[phase] = (seconds + time.time() - start, calls + 1)
+        setattr(obj,attr,timed)
+
+
+    def count(self,obj,attr,counter):
+        """ Wraps the function obj.attr to count its calls in the counter """
+
+        func = getattr(obj,attr)
+        def counted(*args,**kwargs):
+            self.counts[counter] = self.counts.get(counter,0) + 1
+            return func(*args,**kwargs)
+        setattr(obj,attr,counted)
+
+
+    def proxy(self,obj,methods,counter):
+        """
+        Returns a proxy for obj that counts the calls to its methods in the
+        counter, for objects whose methods can't be replaced.
+        """
+
+        return _CountingProxy(self,obj,methods,counter)
+
+
+    def report(self,command):
+        """
+        Prints the phases and counts of the command to stderr, or appends
+        them as a JSON line to the output file.
+        """
+
+        elapsed = time.time() - self.started
+        if self.output in ('1', 'stderr'):
+            ms = lambda seconds: '%.2f ms' % (1000 * seconds)
+            info("profile: %s: %s%s" % (command, ms(elapsed),
+                 '' if self.startup is None else
+                 ' (after %s of startup)' % ms(self.startup)))
+            for phase,(seconds,calls) in sorted(self.phases.iteritems(),
+                                                key=lambda p: -p[1][0]):
+                info("profile:   %-10s %10s  %d call%s" % (
+                     phase, ms(seconds), calls, 's' if calls != 1 else ''))
+            if self.counts:
+                info("profile:   %s" % ', '.join('%s %d' % c
+                     for c in sorted(self.counts.iteritems())))
+            return
+
+        import json
+        import pwd
+
+        # The user comes from the uid, since the environment can be set by
+        # anyone.
+        try:
+            user = pwd.getpwuid(os.getuid()).pw_name
+        except KeyError:
+            user = str(os.getuid())
+        record = {
+            'time': self.started,
+            'user': user,
+            'host': os.uname()[1],
+            'pid': os.getpid(),
+            'command': command,
+            'startup': self.startup,
+            'elapsed': elapsed,
+            'phases': dict((phase,{'seconds': seconds, 'calls': calls})
+                           for phase,(seconds,calls) in self.phases.iteritems()),
+            'counts': self.counts}
+        try:
+            f = open(os.path.expanduser(self.output), 'a')
+            try:
+                f.write(json.dumps(record) + '\n')
+            finally:
+                f.close()
+        except IOError as e:
+            info("can't write profile to '%s': %s" % (self.output, e.strerror))
+
+
+class _CountingProxy:
+    """ Forwards to an object, counting the calls to some of its methods """
+
+    def __init__(self,profile,obj,methods,counter):
+        self._profile = profile
+        self._obj = obj
+        self._methods = methods
+        self._counter = counter
+
+
+    def __getattr__(self,name):
+        if name in self._methods:
+            counts = self._profile.counts
+            counts[self._counter] = counts.get(self._counter,0) + 1
+        return getattr(self._obj,name)
+
+
 # vim:ts=4:shiftwidth=4:expandtab: